@@ -0,0 +1,76 @@
+"""
+Clip search benchmark: HomeServerConnector.find_clips_by_request and export search
+(segment_index.find for last 20 minutes) on synthetic media directory
+(10000 segments of several cameras by default, segment index in separate redis database).
+
+Usage: python -m benchmarks.clip_search [--segments 10000 --cameras 4 --queries 200]
+"""
+import argparse
+import json
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.stand_ins import isolated_redis, synthetic_media
+from threads.server_connector import HomeServerConnector
+from utils.segment_index import segment_index
+from utils.utils import get_clips_by_name
+from config import Config
+
+
+def measure(function, queries: list) -> dict:
+    """ :return: time per query and mean number of found clips """
+    found = 0
+    start = time.perf_counter()
+    for query in queries:
+        found += len(function(query))
+    elapsed = time.perf_counter() - start
+
+    return {'ms_per_query': round(elapsed / len(queries) * 1000, 3), 'clips_per_query': round(found / len(queries), 1)}
+
+
+def run(segments: int, cameras: int, queries: int, window_minutes: int) -> dict:
+    camera_names = [f'Camera{number}' for number in range(cameras)]
+    with tempfile.TemporaryDirectory() as media_path, isolated_redis():
+        start = time.perf_counter()
+        filenames = synthetic_media(media_path, segments, camera_names)
+        fill_time = time.perf_counter() - start
+
+        first = datetime.strptime(filenames[0][:19], Config.DATETIME_FORMAT)
+        last = datetime.strptime(filenames[-1][:19], Config.DATETIME_FORMAT) + Config.VIDEO_DURATION
+        window = timedelta(minutes=window_minutes)
+        requests = []
+        for _ in range(queries):
+            request_start = first + (last - window - first) * random.random()
+            requests.append({'start_time': request_start, 'finish_time': request_start + window})
+
+        connector = HomeServerConnector('127.0.0.1', 'benchmark', 'benchmark', 'benchmark')
+
+        def find_and_split(request):
+            # поиск и разбиение по камерам, как в create_clips_by_request
+            clips = connector.find_clips_by_request(request)
+            return [clip for name in camera_names for clip in get_clips_by_name(clips, name) or []]
+
+        results = {
+            'index_fill_s': round(fill_time, 2),
+            'find_clips_by_request': measure(connector.find_clips_by_request, requests),
+            'find_and_split_by_camera': measure(find_and_split, requests),
+            'find_one_camera': measure(
+                lambda request: segment_index.find(request['start_time'], request['finish_time'], camera_names[:1]),
+                requests),
+        }
+
+    return {'benchmark': 'clip_search', 'segments': segments, 'cameras': cameras, 'queries': queries,
+            'window_minutes': window_minutes, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--segments', type=int, default=10000)
+    parser.add_argument('--cameras', type=int, default=4)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--window', type=int, default=20, help='requested window, minutes')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.segments, args.cameras, args.queries, args.window), indent=2))
@@ -0,0 +1,98 @@
+"""
+Encoder profiles benchmark.
+Reference clip is decoded to raw bgr24 and piped into encoder exactly like CamRecorder does.
+For every profile from Config.ENCODER_PROFILES reports encode fps, fps per cpu core
+(encoder process cpu time only), realtime factor and output bytes per minute.
+
+Usage: python -m benchmarks.encoder_profiles [--clip reference.mp4] [--size 1920x1080 --seconds 20]
+Without --clip a synthetic clip (ffmpeg testsrc2) is used.
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+from typing import List, Tuple
+
+from utils.encoder import build_encoder_command
+from config import Config
+
+
+def probe_size(clip: str) -> Tuple[int, int]:
+    output = subprocess.check_output(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                                      '-show_entries', 'stream=width,height', '-of', 'csv=p=0', clip])
+    width, height = output.decode().strip().split(',')[:2]
+
+    return int(width), int(height)
+
+
+def decoder_command(clip: str, size: str, fps: int, seconds: int) -> List[str]:
+    source = ['-i', clip] if clip else ['-f', 'lavfi', '-i', f'testsrc2=size={size}:rate={fps}']
+
+    return ['ffmpeg', '-v', 'error', *source, '-t', str(seconds), '-r', str(fps),
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+
+
+def encode(profile: dict, width: int, height: int, fps: int, decoder: List[str], output_path: str) -> dict:
+    """ Encode clip with profile, measure wall and encoder cpu time """
+    frame_size = width * height * 3
+    frames = 0
+    command = build_encoder_command(width, height, fps, profile, output_path)
+
+    decoder_process = subprocess.Popen(decoder, stdout=subprocess.PIPE)
+    encoder_process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    start = time.perf_counter()
+    while True:
+        frame = decoder_process.stdout.read(frame_size)
+        if len(frame) < frame_size:
+            break
+        encoder_process.stdin.write(frame)
+        frames += 1
+    encoder_process.stdin.close()
+
+    # wait4 возвращает ресурсы, потраченные только процессом энкодера
+    _, status, usage = os.wait4(encoder_process.pid, 0)
+    encoder_process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+    decoder_process.wait()
+
+    cpu_time = usage.ru_utime + usage.ru_stime
+    size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+    minutes = frames / fps / 60
+
+    return {
+        'returncode': encoder_process.returncode,
+        'frames': frames,
+        'encode_fps': round(frames / elapsed, 1),
+        'encode_fps_per_core': round(frames / cpu_time, 1) if cpu_time else None,
+        'realtime_factor': round(frames / elapsed / fps, 2),
+        'bytes_per_minute': int(size / minutes) if minutes else 0,
+    }
+
+
+def run(clip: str, size: str, fps: int, seconds: int) -> dict:
+    if clip:
+        width, height = probe_size(clip)
+    else:
+        width, height = map(int, size.split('x'))
+    decoder = decoder_command(clip, f'{width}x{height}', fps, seconds)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, profile in Config.ENCODER_PROFILES.items():
+            results[name] = encode(profile, width, height, fps, decoder, os.path.join(temp_dir, f'{name}.mp4'))
+
+    return {'benchmark': 'encoder_profiles', 'clip': clip or 'testsrc2', 'width': width, 'height': height,
+            'fps': fps, 'cpu_count': os.cpu_count(), 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clip', default=None, help='reference clip, recorded by camera')
+    parser.add_argument('--size', default='1920x1080', help='synthetic clip size')
+    parser.add_argument('--fps', type=int, default=Config.FPS)
+    parser.add_argument('--seconds', type=int, default=20)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.clip, args.size, args.fps, args.seconds), indent=2))
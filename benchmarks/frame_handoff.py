@@ -0,0 +1,51 @@
+"""
+Micro-benchmark: per-frame cost of writing a frame into the encoder pipe.
+Compares frame.tobytes() (copy) with frame_to_buffer() (memoryview, no copy).
+
+Usage: python -m benchmarks.frame_handoff --width 1920 --height 1080 --frames 300
+"""
+import argparse
+import json
+import subprocess
+import time
+
+import numpy as np
+
+from utils.utils import frame_to_buffer
+
+
+def measure(frame: np.ndarray, frames: int, handoff) -> float:
+    """
+    Write frames to a pipe read by 'cat > /dev/null'
+    :return: seconds per frame
+    """
+    with subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL) as process:
+        start = time.perf_counter()
+        for _ in range(frames):
+            process.stdin.write(handoff(frame))
+        elapsed = time.perf_counter() - start
+
+    return elapsed / frames
+
+
+def run(width: int, height: int, frames: int) -> dict:
+    frame = np.random.randint(0, 255, (height, width, 3), dtype=np.uint8)
+    results = {}
+    for name, handoff in (('tobytes', lambda f: f.tobytes()), ('memoryview', frame_to_buffer)):
+        per_frame = measure(frame, frames, handoff)
+        results[name] = {
+            'us_per_frame': round(per_frame * 1e6, 1),
+            'mb_per_s': round(frame.nbytes / per_frame / 2 ** 20, 1),
+        }
+
+    return {'benchmark': 'frame_handoff', 'width': width, 'height': height, 'frames': frames, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--frames', type=int, default=300)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.width, args.height, args.frames), indent=2))
@@ -0,0 +1,73 @@
+"""
+ArUco detection benchmark: cost of MarkerDetector.detect, which ArUcoCamRecorder uses (downscale
+and grayscale to shared memory, detection in process pool), per frame resolution and scale.
+Frames are synthetic: noise with one marker and noise without markers.
+
+Usage: python -m benchmarks.marker_detection [--sizes 1280x720,1920x1080 --scales 1,0.5 --frames 50]
+"""
+import argparse
+import json
+import time
+
+import cv2
+import numpy as np
+
+from utils.marker_detector import MarkerDetector, get_pool
+from config import Config
+
+
+def synthetic_frame(width: int, height: int, marker: bool) -> np.ndarray:
+    """ Noise frame, with ArUco marker (DICT_4X4_250, id 0) in the center if marker """
+    frame = np.random.randint(0, 255, (height, width, 3), dtype=np.uint8)
+    if marker:
+        side = height // 4
+        dictionary = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_250)
+        image = cv2.aruco.drawMarker(dictionary, 0, side)
+        # белая рамка вокруг маркера нужна для его поиска
+        border = side // 4
+        image = cv2.copyMakeBorder(image, border, border, border, border, cv2.BORDER_CONSTANT, value=255)
+        y, x = (height - image.shape[0]) // 2, (width - image.shape[1]) // 2
+        frame[y:y + image.shape[0], x:x + image.shape[1]] = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+    return frame
+
+
+def measure(detector: MarkerDetector, frame: np.ndarray, frames: int) -> dict:
+    results = []
+    start = time.perf_counter()
+    for _ in range(frames):
+        results.append(detector.detect(frame))
+    elapsed = time.perf_counter() - start
+
+    return {'ms_per_frame': round(elapsed / frames * 1000, 2), 'found': sum(results) / frames}
+
+
+def run(sizes: list, scales: list, frames: int) -> dict:
+    get_pool()  # запуск процессов пула не входит в замер
+    results = {}
+    for size in sizes:
+        width, height = map(int, size.split('x'))
+        with_marker = synthetic_frame(width, height, True)
+        without_marker = synthetic_frame(width, height, False)
+        for scale in scales:
+            detector = MarkerDetector(scale=scale)
+            detector.detect(with_marker)  # shared memory создается при первом кадре
+            results[f'{size}@{scale}'] = {
+                'marker': measure(detector, with_marker, frames),
+                'no_marker': measure(detector, without_marker, frames),
+            }
+            detector.close()
+
+    return {'benchmark': 'marker_detection', 'frames': frames, 'workers': Config.ARUCO_WORKERS,
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='640x360,1280x720,1920x1080')
+    parser.add_argument('--scales', default=f'1,{Config.ARUCO_DETECT_SCALE}')
+    parser.add_argument('--frames', type=int, default=50)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.sizes.split(','), [float(scale) for scale in args.scales.split(',')], args.frames),
+                     indent=2))
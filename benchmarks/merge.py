@@ -0,0 +1,74 @@
+"""
+Merge benchmark: latency of merge_clips on synthetic segments - whole segments, requested window
+(cut on keyframes and with Config.PRECISE_CLIP_START) and merge of several cameras in merge_pool.
+
+Usage: python -m benchmarks.merge [--clips 3 --clip-seconds 60 --cameras 2 --size 1920x1080]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.stand_ins import synthetic_clip, override_config
+from utils.utils import merge_clips, merge_clips_concurrently
+from config import Config
+
+
+def measure(merge, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = merge()
+        times.append(time.perf_counter() - start)
+        for output in outputs:
+            os.remove(os.path.join(Config.TEMP_PATH, output))
+
+    return {'mean_s': round(sum(times) / repeat, 3), 'max_s': round(max(times), 3)}
+
+
+def run(clips: int, clip_seconds: int, cameras: int, size: str, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            override_config(MEDIA_PATH=os.path.join(temp_dir, 'media'), TEMP_PATH=os.path.join(temp_dir, 'temp'),
+                            PRECISE_CLIP_START=False):
+        os.makedirs(Config.MEDIA_PATH)
+        os.makedirs(Config.TEMP_PATH)
+
+        source = synthetic_clip(os.path.join(temp_dir, 'source.mp4'), size, Config.FPS, clip_seconds)
+        first_start = datetime.now().replace(microsecond=0) - timedelta(seconds=clips * clip_seconds)
+        jobs = []
+        for camera in range(cameras):
+            job = []
+            for number in range(clips):
+                start_time = first_start + timedelta(seconds=number * clip_seconds)
+                filename = f'{start_time.strftime(Config.DATETIME_FORMAT)}_Camera{camera}.mp4'
+                os.link(source, os.path.join(Config.MEDIA_PATH, filename))
+                job.append(filename)
+            jobs.append(job)
+
+        # запрошенный отрезок начинается и заканчивается в середине первого и последнего сегментов
+        window_start = first_start + timedelta(seconds=clip_seconds / 2 + 0.5)
+        window_finish = first_start + timedelta(seconds=(clips - 0.5) * clip_seconds)
+
+        results = {'whole': measure(lambda: [merge_clips(jobs[0])], repeat),
+                   'window': measure(lambda: [merge_clips(jobs[0], window_start, window_finish)], repeat)}
+        with override_config(PRECISE_CLIP_START=True):
+            results['window_precise'] = measure(lambda: [merge_clips(jobs[0], window_start, window_finish)], repeat)
+        results['cameras_concurrently'] = measure(
+            lambda: list(merge_clips_concurrently(jobs, window_start, window_finish)), repeat)
+
+    return {'benchmark': 'merge', 'clips': clips, 'clip_seconds': clip_seconds, 'cameras': cameras,
+            'size': size, 'merge_workers': Config.MERGE_WORKERS, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clips', type=int, default=3, help='segments in one merge')
+    parser.add_argument('--clip-seconds', type=int, default=60)
+    parser.add_argument('--cameras', type=int, default=2)
+    parser.add_argument('--size', default='1920x1080')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.clips, args.clip_seconds, args.cameras, args.size, args.repeat), indent=2))
@@ -0,0 +1,82 @@
+"""
+Recording benchmark: one segment is recorded by CamRecorder.record_video from synthetic camera.
+'file' source - clip is decoded as fast as possible (recorder throughput, ring buffer blocks
+instead of dropping frames), 'live' source - frames come at camera rate (cpu cost of realtime recording).
+Reports recorded fps, dropped frames, mean write time to encoder, cpu time of recorder
+process (capture and decoding) and of encoder.
+
+Usage: python -m benchmarks.recording [--source file|live] [--size 1920x1080 --seconds 20 --profile mpeg4]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+from benchmarks.stand_ins import isolated_redis, synthetic_clip, live_camera, override_config
+from threads.cam_recorder import CamRecorder
+from utils.segment_index import segment_index
+from config import Config
+
+
+def record(url: str, media_path: str, seconds: int, fps: int) -> dict:
+    recorder = CamRecorder(url, 'benchmark', timedelta(seconds=seconds), media_path, fps)
+    recorder.check_capture()
+    # метрики общие для рекордеров с одним именем камеры - считается разница за запись
+    write_time = recorder.write_latency
+    write_sum, write_count = write_time.sum, write_time.count
+
+    times_before = os.times()
+    start = time.perf_counter()
+    filename = recorder.record_video()
+    elapsed = time.perf_counter() - start
+    times_after = os.times()
+    dropped = recorder.frame_buffer.dropped
+    recorder.release_capture()
+
+    frames = segment_index.get(filename)['frames']
+    write_count = write_time.count - write_count
+    recorder_cpu = (times_after.user + times_after.system) - (times_before.user + times_before.system)
+    # энкодер завершен внутри record_video - его время уже в children
+    encoder_cpu = (times_after.children_user + times_after.children_system) - \
+                  (times_before.children_user + times_before.children_system)
+
+    return {
+        'frames': frames,
+        'dropped_frames': dropped,
+        'record_fps': round(frames / elapsed, 1),
+        'realtime_factor': round(frames / elapsed / fps, 2),
+        'write_ms': round((write_time.sum - write_sum) / write_count * 1000, 3) if write_count else None,
+        'recorder_cpu_s': round(recorder_cpu, 2),
+        'encoder_cpu_s': round(encoder_cpu, 2),
+        'cpu_ms_per_frame': round((recorder_cpu + encoder_cpu) / frames * 1000, 2) if frames else None,
+        'segment_bytes': os.path.getsize(os.path.join(media_path, filename)),
+    }
+
+
+def run(source: str, size: str, fps: int, seconds: int, profile: str) -> dict:
+    with tempfile.TemporaryDirectory() as temp_dir, isolated_redis(), override_config(ENCODER_PROFILE=profile):
+        if source == 'live':
+            with live_camera(size, fps) as url:
+                results = record(url, temp_dir, seconds, fps)
+        else:
+            # клип длиннее сегмента: конец файла не должен обрывать запись
+            clip = synthetic_clip(os.path.join(temp_dir, 'source.mp4'), size, fps, seconds + 2)
+            with override_config(FRAME_BUFFER_POLICY='block'):
+                results = record(clip, temp_dir, seconds, fps)
+
+    return {'benchmark': 'recording', 'source': source, 'size': size, 'fps': fps, 'seconds': seconds,
+            'profile': profile, 'cpu_count': os.cpu_count(), 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', choices=('file', 'live'), default='file')
+    parser.add_argument('--size', default='1920x1080')
+    parser.add_argument('--fps', type=int, default=Config.FPS)
+    parser.add_argument('--seconds', type=int, default=20, help='segment length')
+    parser.add_argument('--profile', default=Config.ENCODER_PROFILE, choices=sorted(Config.ENCODER_PROFILES))
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.source, args.size, args.fps, args.seconds, args.profile), indent=2))
@@ -0,0 +1,275 @@
+"""
+Local stand-ins for cameras, storage server and database, used by benchmarks.
+Synthetic camera is ffmpeg testsrc2: a clip file (frames are read as fast as decoder can)
+or a live mpegts stream over TCP (frames at camera rate), both are opened by CamRecorder
+instead of rtsp url. SFTP server is paramiko in a thread, database is SQLite with the tables,
+which DBConnect automaps. Redis clients of utils.redis_client are switched to a separate
+database, so benchmarks don't touch queues and segment index of the recorder.
+"""
+import os
+import socket
+import subprocess
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import sleep
+from typing import Iterator, List, Optional
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, ServerInterface
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Integer, MetaData, String, Table, create_engine
+
+from utils import db
+from utils.encoder import encoder_args
+from utils.redis_client import redis_client, redis_client_pickle
+from utils.segment_index import segment_index
+from config import Config
+
+REDIS_DB = 15  # отдельная база redis для бенчмарков, очищается до и после
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def synthetic_clip(path: str, size: str = '1280x720', fps: int = Config.FPS, seconds: float = 10,
+                   profile: Optional[dict] = None) -> str:
+    """
+    Clip in the same format as recorded segments (fragmented mp4)
+    :return: path
+    """
+    profile = profile or Config.ENCODER_PROFILES[Config.ENCODER_PROFILE]
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate={fps}',
+                    '-t', str(seconds), '-an', *encoder_args(profile, fps),
+                    '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov', path], check=True)
+
+    return path
+
+
+@contextmanager
+def live_camera(size: str = '1280x720', fps: int = Config.FPS) -> Iterator[str]:
+    """
+    Synthetic camera, which sends frames in real time (ffmpeg -re) as mpegts over TCP
+    :return: url for CamRecorder
+    """
+    port = free_port()
+    profile = Config.ENCODER_PROFILES['mpeg4']
+    process = subprocess.Popen(['ffmpeg', '-v', 'error', '-re', '-f', 'lavfi',
+                                '-i', f'testsrc2=size={size}:rate={fps}', '-an', *encoder_args(profile, fps),
+                                '-f', 'mpegts', f'tcp://127.0.0.1:{port}?listen=1'])
+    try:
+        sleep(1)  # ffmpeg начинает слушать порт
+        yield f'tcp://127.0.0.1:{port}'
+    finally:
+        process.kill()
+        process.wait()
+
+
+@contextmanager
+def override_config(**values) -> Iterator[None]:
+    """ Temporary Config values (paths, workers...), previous values are restored on exit """
+    previous = {name: getattr(Config, name) for name in values}
+    for name, value in values.items():
+        setattr(Config, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(Config, name, value)
+
+
+@contextmanager
+def isolated_redis(redis_db: int = REDIS_DB) -> Iterator[None]:
+    """ Switch redis clients (queues, segment index, logger) to separate database """
+    clients = (redis_client, redis_client_pickle)
+    originals = [client.client for client in clients]
+    for client in clients:
+        client.client = type(client)(host='127.0.0.1', db=redis_db).client
+    redis_client.client.flushdb()
+    try:
+        yield
+    finally:
+        redis_client.client.flushdb()
+        for client, original in zip(clients, originals):
+            client.client = original
+
+
+def synthetic_media(media_path: str, count: int, camera_names: List[str],
+                    start_time: Optional[datetime] = None, duration: timedelta = Config.VIDEO_DURATION,
+                    size: int = 0) -> List[str]:
+    """
+    Media directory with count segments (files of 'size' bytes) of cameras recorded one after another,
+    segments are added to segment index
+    :return: filenames
+    """
+    segments_per_camera = -(-count // len(camera_names))
+    start_time = start_time or datetime.now().replace(microsecond=0) - duration * segments_per_camera
+    filenames = []
+    for number in range(count):
+        camera_name = camera_names[number % len(camera_names)]
+        segment_start = start_time + duration * (number // len(camera_names))
+        filename = f'{segment_start.strftime(Config.DATETIME_FORMAT)}_{camera_name}.mp4'
+        with open(os.path.join(media_path, filename), 'wb') as file:
+            if size:
+                file.write(os.urandom(size))
+        segment_index.add(filename, segment_start, segment_start + duration,
+                          frames=int(duration.total_seconds()) * Config.FPS, size=size)
+        filenames.append(filename)
+
+    return filenames
+
+
+class _Server(ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _SFTPRoot(SFTPServerInterface):
+    """ SFTP server, which serves files of root directory (class attribute is set by sftp_server) """
+    root = None
+
+    def _path(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path.replace('\\', '/')).replace('//', '/')
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags, 0o644)
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+        mode = 'r+b' if flags & os.O_RDWR else 'wb' if flags & os.O_WRONLY else 'rb'
+        handle = _Handle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._path(newpath)):
+            return paramiko.SFTP_FAILURE
+        os.rename(self._path(oldpath), self._path(newpath))
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(self._path(oldpath), self._path(newpath))
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+@contextmanager
+def sftp_server(root: str) -> Iterator[int]:
+    """
+    Local SFTP server (any username and password), which stores files in root.
+    'check-file' of paramiko server is not usable for large files - disable Config.SFTP_VERIFY_CHECKSUM.
+    :return: port
+    """
+    _SFTPRoot.root = root
+    key = paramiko.RSAKey.generate(2048)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    transports = []
+
+    def accept():
+        while True:
+            try:
+                connection, _ = sock.accept()
+            except OSError:
+                return  # сокет закрыт
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(key)
+            transport.set_subsystem_handler('sftp', SFTPServer, _SFTPRoot)
+            transport.start_server(server=_Server())
+            transports.append(transport)
+
+    threading.Thread(target=accept, daemon=True).start()
+    try:
+        yield sock.getsockname()[1]
+    finally:
+        sock.close()
+        for transport in transports:
+            transport.close()
+
+
+def sqlite_database(path: str, license_table: str = Config.CAR_LICENSE_TABLE) -> str:
+    """
+    SQLite database with tables of storage server (only columns, which are used by DBConnect)
+    and car record. Engine is put to utils.db cache: engine for postgres is created with options,
+    which SQLite doesn't support. Reflected schema is cached to Config.DB_SCHEMA_CACHE,
+    set it to separate file.
+    :return: database url for DBConnect
+    """
+    url = f'sqlite:///{path}'
+    engine = create_engine(url, connect_args={'check_same_thread': False, 'timeout': 30})
+    metadata = MetaData()
+    car = Table('car', metadata,
+                Column('id', Integer, primary_key=True),
+                Column('license_table', String),
+                Column('last_seen', DateTime),
+                Column('ip_address', String),
+                Column('loading', Boolean, default=False))
+    Table('request', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('car_id', Integer, ForeignKey('car.id')),
+          Column('start_time', DateTime),
+          Column('finish_time', DateTime),
+          Column('delivered', Boolean, default=False),
+          Column('record_status', Boolean))
+    Table('record', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('file_name', String),
+          Column('car_id', Integer, ForeignKey('car.id')),
+          Column('start_time', DateTime),
+          Column('end_time', DateTime),
+          Column('request_id', Integer, ForeignKey('request.id')))
+    Table('gps', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('car_id', Integer, ForeignKey('car.id')),
+          Column('latitude', Float),
+          Column('longitude', Float),
+          Column('datetime', DateTime))
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(car.insert().values(license_table=license_table))
+
+    db._engines[url] = engine
+
+    return url
@@ -0,0 +1,98 @@
+"""
+All offline benchmarks in one run (synthetic camera, local SFTP server, SQLite, separate redis database).
+Result is JSON with git revision, it is saved between releases and compared:
+
+    python -m benchmarks.suite --output benchmarks-1.4.json
+    python -m benchmarks.suite --output benchmarks-1.5.json --compare benchmarks-1.4.json
+
+Comparison prints every numeric result, which changed more than --threshold percent.
+Benchmarks which can't run here (no ffmpeg, no redis...) are reported with error.
+
+Usage: python -m benchmarks.suite [--only recording,merge] [--output result.json] [--compare previous.json]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import traceback
+from typing import Dict, Iterator, Tuple
+
+from benchmarks import clip_search, encoder_profiles, marker_detection, merge, recording, upload
+from config import Config
+
+BENCHMARKS = {
+    'recording': lambda: recording.run('file', '1920x1080', Config.FPS, 20, Config.ENCODER_PROFILE),
+    'marker_detection': lambda: marker_detection.run(['640x360', '1280x720', '1920x1080'],
+                                                     [1.0, Config.ARUCO_DETECT_SCALE], 50),
+    'clip_search': lambda: clip_search.run(10000, 4, 200, 20),
+    'merge': lambda: merge.run(3, 60, 2, '1920x1080', 3),
+    'upload': lambda: upload.run(20, 16, [1, Config.UPLOAD_WORKERS], None),
+    'encoder_profiles': lambda: encoder_profiles.run(None, '1920x1080', Config.FPS, 20),
+}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=Config.PATH,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def flatten(result, prefix: str = '') -> Iterator[Tuple[str, float]]:
+    """ Numeric leaves of result as ('benchmark.results.key...', value) """
+    if isinstance(result, dict):
+        for key, value in result.items():
+            yield from flatten(value, f'{prefix}.{key}' if prefix else key)
+    elif isinstance(result, (int, float)) and not isinstance(result, bool):
+        yield prefix, result
+
+
+def compare(current: Dict, previous: Dict, threshold: float) -> None:
+    """ Print results, which changed more than threshold percent """
+    previous_values = dict(flatten(previous['benchmarks']))
+    for key, value in flatten(current['benchmarks']):
+        before = previous_values.get(key)
+        if not before:
+            continue
+        change = (value - before) / abs(before) * 100
+        if abs(change) >= threshold:
+            print(f'{key}: {before} -> {value} ({change:+.0f}%)')
+
+
+def run(names: list) -> dict:
+    results = {}
+    for name in names:
+        start = time.perf_counter()
+        try:
+            results[name] = BENCHMARKS[name]()
+        except Exception as error:
+            traceback.print_exc()
+            results[name] = {'error': str(error)}
+        results[name]['duration_s'] = round(time.perf_counter() - start, 1)
+
+    return {'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count(),
+            'benchmarks': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help='comma separated benchmarks')
+    parser.add_argument('--output', default=None, help='JSON file (stdout by default)')
+    parser.add_argument('--compare', default=None, help='JSON of previous run')
+    parser.add_argument('--threshold', type=float, default=10, help='percent')
+    args = parser.parse_args()
+
+    result = run(args.only.split(','))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(result, json.load(file), args.threshold)
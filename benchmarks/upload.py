@@ -0,0 +1,77 @@
+"""
+Upload benchmark: HomeServerConnector.upload_regular_files (parallel SFTP channels, record
+in database for every file) against local SFTP server and SQLite database
+(or local Postgres with schema of storage server: --database-url).
+Reports throughput and mean database session time for several numbers of upload workers.
+
+Usage: python -m benchmarks.upload [--files 20 --file-size 16 --workers 1,3]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Optional
+
+from benchmarks.stand_ins import isolated_redis, override_config, sftp_server, sqlite_database, synthetic_media
+from threads.server_connector import HomeServerConnector
+from utils.db import db_session_time
+from utils.redis_client import upload_queue
+from utils.sftp_uploader import SFTPUploader
+from config import Config
+
+
+def upload(connector: HomeServerConnector, media_path: str, files: int, file_size: int) -> dict:
+    for filename in synthetic_media(media_path, files, ['Camera0'], size=file_size):
+        upload_queue.put(filename)
+
+    db_sum, db_count = db_session_time.sum, db_session_time.count
+    start = time.perf_counter()
+    connector.uploader.connect()
+    connector.upload_regular_files()
+    elapsed = time.perf_counter() - start
+    db_count = db_session_time.count - db_count
+
+    uploaded = files - len(upload_queue)
+    return {
+        'uploaded_files': uploaded,
+        'mb_per_s': round(uploaded * file_size / 2 ** 20 / elapsed, 1),
+        'files_per_s': round(uploaded / elapsed, 1),
+        'db_session_ms': round((db_session_time.sum - db_sum) / db_count * 1000, 2) if db_count else None,
+    }
+
+
+def run(files: int, file_size_mb: int, workers: list, database_url: Optional[str]) -> dict:
+    file_size = file_size_mb * 2 ** 20
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir, isolated_redis(), \
+            override_config(MEDIA_PATH=os.path.join(temp_dir, 'media'), DESTINATION_DISK='/',
+                            SFTP_VERIFY_CHECKSUM=False, UPLOAD_WORKERS=Config.UPLOAD_WORKERS,
+                            DB_SCHEMA_CACHE=os.path.join(temp_dir, 'db_schema.pickle'),
+                            DATABASE_URL=database_url or sqlite_database(os.path.join(temp_dir, 'server.sqlite'))):
+        server_root = os.path.join(temp_dir, 'server')
+        os.makedirs(Config.MEDIA_PATH)
+        os.makedirs(os.path.join(server_root, Config.DESTINATION_TEMP))
+
+        with sftp_server(server_root) as port:
+            connector = HomeServerConnector('127.0.0.1', 'benchmark', 'benchmark', server_root)
+            connector.uploader = SFTPUploader('127.0.0.1', 'benchmark', 'benchmark', port=port)
+            for workers_count in workers:
+                Config.UPLOAD_WORKERS = workers_count
+                results[f'workers_{workers_count}'] = upload(connector, Config.MEDIA_PATH, files, file_size)
+            connector.uploader.close()
+
+    return {'benchmark': 'upload', 'files': files, 'file_size_mb': file_size_mb,
+            'database': 'sqlite' if database_url is None else database_url.split(':')[0], 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--file-size', type=int, default=16, help='Mb')
+    parser.add_argument('--workers', default=f'1,{Config.UPLOAD_WORKERS}')
+    parser.add_argument('--database-url', default=None, help='local Postgres instead of SQLite')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.files, args.file_size, [int(workers) for workers in args.workers.split(',')],
+                         args.database_url), indent=2))
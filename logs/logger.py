@@ -1,20 +1,52 @@
 import datetime
+import multiprocessing
 import os
+import threading
 
 from loguru import logger
 
 from utils.redis_client import redis_client
 from config import Config
 
+LOG_FORMAT = '{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {message}'
 
-logger.add(
-    os.path.join(Config.PATH, 'logs', 'data', 'logs.log'),
-    format='{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {message}',
-    level='DEBUG',
-    rotation='1 MB',
-    compression='zip',
-    backtrace=True,
-)
+# файл с ротацией пишет только основной процесс, процессы камер отправляют сообщения ему (send_to_parent)
+if multiprocessing.parent_process() is None:
+    logger.add(
+        os.path.join(Config.PATH, 'logs', 'data', 'logs.log'),
+        format=LOG_FORMAT,
+        level='DEBUG',
+        rotation='1 MB',
+        compression='zip',
+        backtrace=True,
+    )
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def _write_child_messages(queue: multiprocessing.Queue) -> None:
+    while True:
+        level, message = queue.get()
+        logger.opt(raw=True).log(level, message)
+
+
+def log_queue() -> multiprocessing.Queue:
+    """ Queue for messages of child processes, main process writes them to its log """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = multiprocessing.get_context('spawn').Queue()
+            threading.Thread(target=_write_child_messages, args=(_queue,), name='ChildLogs', daemon=True).start()
+
+    return _queue
+
+
+def send_to_parent(queue: multiprocessing.Queue) -> None:
+    """ Child process: messages are formatted here and sent to main process (log_queue of it) """
+    logger.remove()
+    logger.add(lambda message: queue.put((message.record['level'].name, str(message))),
+               format=LOG_FORMAT, level='DEBUG', backtrace=True)
 
 
 class Logger:
@@ -33,3 +65,9 @@ class Logger:
 
     def info(self, message):
         self.logger.info(f'{self.name} {message}')
+
+    def notify(self, message):
+        """ Info message, which is also sent to telegram chat """
+        self.logger.info(f'{self.name} {message}')
+        redis_client.lpush('error_messages',
+                           f'   {datetime.datetime.now().strftime("%H:%M:%S")} \n{self.name} \n{message}')
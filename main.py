@@ -1,13 +1,14 @@
 import os
-from time import sleep
 
-from threads.cam_recorder import CamRecorder, ArUcoCamRecorder
+from threads.cam_recorder import CamRecorder, ArUcoCamRecorder, StreamCopyCamRecorder
+from threads.recorder_process import RecorderProcess
 from threads.test_video_external_device import ExportMovieToExternalDrive
 from threads.server_connector import HomeServerConnector
 from threads.gps_tracker import GPSEmulator
 from threads.bot import CarBot
 from threads.media_remover import MediaRemover
-from utils.utils import check_unfinished_records
+from utils.segment_index import segment_index, check_unfinished_records
+from utils.metrics import metrics
 from config import Config
 
 from logs.logger import Logger
@@ -15,6 +16,22 @@ from logs.logger import Logger
 logger = Logger('Main')
 
 
+def start_recorder(recorder_class, url, name):
+    """ Запуск рекордера камеры в потоке или в отдельном процессе (Config.RECORDER_PROCESSES) """
+    recorder_kwargs = dict(
+        url=url,
+        camera_name=name,
+        video_loop_size=Config.VIDEO_DURATION,
+        media_path=Config.MEDIA_PATH,
+        fps=Config.FPS,
+    )
+    if Config.RECORDER_PROCESSES:
+        cam_recorder = RecorderProcess(recorder_class, **recorder_kwargs)
+    else:
+        cam_recorder = recorder_class(**recorder_kwargs)
+    cam_recorder.start()
+
+
 if __name__ == '__main__':
     if not os.path.exists(Config.MEDIA_PATH):
         os.mkdir(Config.MEDIA_PATH)
@@ -24,10 +41,15 @@ if __name__ == '__main__':
     logger.info('_'*50)
     logger.info('Start')
 
+    metrics.start('main', serve=Config.METRICS_ENABLED)
+
+    if not segment_index.count():
+        segment_index.rebuild(Config.MEDIA_PATH)  # первичное заполнение индекса уже записанными файлами
+
     media_exporter = ExportMovieToExternalDrive()
     media_exporter.start()
 
-    check_unfinished_records()  # добавление файлов, которые не записались до конца, в очередь на выгрузку
+    check_unfinished_records()  # завершение файлов из журнала записи (до запуска камер)
 
     server_connector = HomeServerConnector(
         url=Config.STORAGE_SERVER_URL,
@@ -40,31 +62,19 @@ if __name__ == '__main__':
     car_bot = CarBot(Config.TELEGRAM_BOT_TOKEN, Config.CHAT_ID, Config.CAR_LICENSE_TABLE)
     car_bot.start()
 
-    media_remover = MediaRemover(check_interval=(Config.VIDEO_DURATION.total_seconds() // 2),
+    media_remover = MediaRemover(check_interval=Config.MEDIA_REMOVER_INTERVAL,
+                                 min_free_space=Config.MIN_FREE_SPACE,
+                                 target_free_space=Config.TARGET_FREE_SPACE,
                                  media_path=Config.MEDIA_PATH)
     media_remover.start()
 
-    sleep(30)  # Ожидание инициализации камер
-
+    # камеры подключаются параллельно, каждая начинает запись, как только получен первый кадр
     for url, name in Config.ARUCO_CAMERAS:
-        cam_recorder = ArUcoCamRecorder(
-            url=url,
-            camera_name=name,
-            video_loop_size=Config.VIDEO_DURATION,
-            media_path=Config.MEDIA_PATH,
-            fps=Config.FPS,
-        )
-        cam_recorder.start()
+        start_recorder(ArUcoCamRecorder, url, name)
 
     for url, name in Config.CAMERAS:
-        cam_recorder = CamRecorder(
-            url=url,
-            camera_name=name,
-            video_loop_size=Config.VIDEO_DURATION,
-            media_path=Config.MEDIA_PATH,
-            fps=Config.FPS,
-        )
-        cam_recorder.start()
+        recorder_class = StreamCopyCamRecorder if name in Config.STREAM_COPY_CAMERAS else CamRecorder
+        start_recorder(recorder_class, url, name)
 
     # gps_tracker = GPSEmulator()
     # gps_tracker.start()
@@ -7,7 +7,8 @@ import requests
 from config import Config
 from utils.redis_client import redis_client
 from utils.utils import ping_server, get_self_ip, function_call_log
-from utils.variables import READY_TO_UPLOAD, READY_REQUESTED_FILES, ERROR_MESSAGES
+from utils.variables import READY_TO_UPLOAD, READY_REQUESTED_FILES, ERROR_MESSAGES, CONNECTOR_EVENTS, \
+    NETWORK_CONNECTION
 from logs.logger import Logger
 
 
@@ -53,6 +54,8 @@ class CarBot(Thread):
 
         if status:
             if not self.network_status:
+                # сеть появилась - выгрузка начинается сразу, не дожидаясь следующего цикла
+                redis_client.publish(CONNECTOR_EVENTS, NETWORK_CONNECTION)
                 local_ip = get_self_ip()
                 self.send_message(f'Машина в сети. Адрес: {local_ip}')
                 self.network_status = True
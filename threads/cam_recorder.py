@@ -2,40 +2,166 @@ import os
 import subprocess
 import threading
 from datetime import datetime, timedelta
-from time import sleep
+from time import sleep, time, perf_counter
+from typing import List, Optional, TextIO, Tuple
 
 import cv2
 
-from utils.redis_client import redis_client
+from utils.redis_client import upload_queue
+from utils.segment_index import segment_index, check_unfinished_records
+from utils.state_cache import state_cache
 from utils.error import RTSPError
-from utils.variables import READY_TO_UPLOAD, NETWORK_CONNECTION, LOADING_STATUS
+from utils.frame_buffer import FrameRingBuffer
+from utils.marker_detector import MarkerDetector
+from utils.reconnect import Reconnector
+from utils.metrics import metrics
+from utils.utils import frame_to_buffer, clip_start_time, temp_file, PARTIAL_SUFFIX
+from utils.encoder import get_encoder_profile, build_encoder_command, build_stream_encoder_command, \
+    build_remux_command
+from utils.preroll import PrerollBuffer
+from threads.frame_grabber import FrameGrabber
+from utils.variables import NETWORK_CONNECTION, LOADING_STATUS
 from logs.logger import Logger
 from config import Config
 
+# rtsp по TCP: без потерь пакетов (серых кадров) на нагруженной сети
+os.environ.setdefault('OPENCV_FFMPEG_CAPTURE_OPTIONS', 'rtsp_transport;tcp')
+
 
 class CamRecorder(threading.Thread):
     def __init__(self, url: str, camera_name: str, video_loop_size: timedelta, media_path, fps):
         super().__init__()
 
-        self.capture = cv2.VideoCapture(url)
         self.url = url
+        self.capture = None  # подключение к камере - в run(), параллельно с остальными камерами
         self.fps = fps
         self.camera_name = camera_name
         self.filename = f'{self.camera_name}.mp4'
-        self.width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.width = 0
+        self.height = 0
+        self.started_at = time()
+        self.first_frame_logged = False
         self.out = None
+        self.frame_buffer = None
+        self.grabber = None
         self.total_frames = int(video_loop_size.total_seconds()) * self.fps
         self.media_path = media_path
+        self.encoder_profile = get_encoder_profile(self.camera_name)
         self.logger = Logger(self.camera_name)
+        self.reconnector = Reconnector(self.logger)
+
+        # метрики обновляются раз в сегмент или считаются при сборе, в цикле кадров - только время записи
+        labels = dict(camera=self.camera_name)
+        self.write_latency = metrics.histogram('recorder_encoder_write_seconds',
+                                               'Time of writing one frame to encoder').labels(**labels)
+        self.frames_recorded = metrics.counter('recorder_frames_total', 'Frames written to segments').labels(**labels)
+        self.frames_dropped = metrics.counter('recorder_frames_dropped_total',
+                                              'Frames dropped from ring buffer').labels(**labels)
+        self.segments_recorded = metrics.counter('recorder_segments_total', 'Recorded segments').labels(**labels)
+        metrics.gauge('recorder_target_fps', 'Config.FPS').labels(**labels).set(self.fps)
+        metrics.gauge('recorder_capture_fps', 'Frames per second received from camera').labels(
+            **labels).set_function(self.capture_fps)
+        self.fps_sample = (0, time())
+
+    def open_capture(self):
+        """ Подключение к rtsp стриму с таймаутами подключения и чтения """
+        return cv2.VideoCapture(self.url, cv2.CAP_FFMPEG, [
+            cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(Config.RTSP_OPEN_TIMEOUT * 1000),
+            cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(Config.RTSP_READ_TIMEOUT * 1000),
+        ])
+
+    def connect(self) -> None:
+        """ Подключение к камере, размер кадра берется из стрима """
+        self.capture = self.open_capture()
+        if not self.capture.isOpened():
+            self.release_capture()
+            raise RTSPError(False, False)
+        self.width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def release_capture(self) -> None:
+        """ Остановка чтения кадров и отключение от камеры (следующая проверка подключится заново) """
+        grabber = self.grabber
+        self.stop_capture()
+        if self.capture is not None:
+            if grabber is not None and grabber.is_alive():
+                # поток чтения завис в capture.read() - освобождать capture из другого потока нельзя
+                self.logger.info('frame grabber is stuck, capture is abandoned')
+            else:
+                self.capture.release()
+            self.capture = None
+
+    def start_capture(self) -> None:
+        """ Запуск потока чтения кадров из rtsp стрима в кольцевой буфер """
+        self.stop_capture()
+        shape = (self.height, self.width, 3) if self.width and self.height else None
+        self.frame_buffer = FrameRingBuffer(Config.FRAME_BUFFER_SIZE, shape, Config.FRAME_BUFFER_POLICY)
+        self.grabber = FrameGrabber(self.capture, self.frame_buffer, self.camera_name)
+        self.grabber.start()
+
+    def stop_capture(self) -> None:
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber.join(timeout=5)
+            self.grabber = None
+
+    def read(self):
+        """
+        Получение следующего кадра из кольцевого буфера.
+        Если кадра нет дольше Config.FRAME_READ_TIMEOUT, стрим считается зависшим:
+        буфер закрывается, следующая проверка подключится к камере заново.
+        :return: (status, frame), как у cv2.VideoCapture.read()
+        """
+        frame = self.frame_buffer.get(timeout=Config.FRAME_READ_TIMEOUT)
+        if frame is None and not self.frame_buffer.closed:
+            self.logger.info(f'no frames for {Config.FRAME_READ_TIMEOUT} s, stream is stalled')
+            self.frame_buffer.close(RTSPError(False, True))
+        return frame is not None, frame
+
+    def write_frame(self, process: subprocess.Popen, frame) -> None:
+        """ Запись кадра в энкодер (с замером времени записи) """
+        start = perf_counter()
+        process.stdin.write(frame_to_buffer(frame))
+        self.write_latency.observe(perf_counter() - start)
+
+    def capture_fps(self) -> float:
+        """ Кадров в секунду из стрима с предыдущего сбора метрик """
+        received = self.frame_buffer.received if self.frame_buffer is not None else 0
+        now = time()
+        last_received, last_time = self.fps_sample
+        self.fps_sample = (received, now)
+        if received < last_received:
+            last_received = 0  # буфер пересоздан после переподключения
+
+        return (received - last_received) / (now - last_time) if now > last_time else 0.0
+
+    def log_dropped_frames(self, dropped_before: int) -> None:
+        """ Кадры, выброшенные из буфера, пока энкодер не успевал их записывать """
+        dropped = self.frame_buffer.dropped - dropped_before
+        self.frames_dropped.inc(dropped)
+        if dropped:
+            self.logger.info(f'{dropped} frames dropped (total: {self.frame_buffer.dropped}), '
+                             f'encoder can\'t keep up')
 
     def check_capture(self) -> bool:
         """ Проверка получения видео из rtsp стрима """
-        frame_status, _ = self.capture.read()
+        if self.frame_buffer is not None and self.frame_buffer.closed:
+            # чтение кадров остановилось (ошибка или зависание) - новое подключение
+            self.release_capture()
+        if self.capture is None:
+            self.connect()
+        if self.frame_buffer is None or self.frame_buffer.closed:
+            self.start_capture()
+        frame_status, _ = self.read()
         stream_status = self.capture.isOpened()
         if not frame_status or not stream_status:
             raise RTSPError(frame_status, stream_status)
 
+        self.reconnector.succeeded()
+        if not self.first_frame_logged:
+            self.logger.info(f'first frame in {time() - self.started_at:.1f} s')
+            self.first_frame_logged = True
+
         return True
 
     def initial_check(self) -> bool:
@@ -44,54 +170,89 @@ class CamRecorder(threading.Thread):
         :return:
         """
         for _ in range(5):
-            status, _ = self.capture.read()
+            status, _ = self.read()
             if not status:
                 return False
 
         return True
 
-    def create_filename(self) -> str:
+    def create_filename(self, start_time: datetime) -> str:
         """
         Создание имени файла
         :return: str
         """
-        datetime_string = datetime.strftime(datetime.now(), Config.DATETIME_FORMAT)
+        datetime_string = datetime.strftime(start_time, Config.DATETIME_FORMAT)
 
         return f'{datetime_string}_{self.filename}'
 
+    def partial_path(self, filename: str) -> str:
+        """ Путь, по которому записывается незаконченный сегмент """
+        return os.path.join(self.media_path, filename + PARTIAL_SUFFIX)
+
+    def start_segment(self, start_time: datetime) -> str:
+        """
+        Добавление сегмента в индекс и журнал записываемых файлов
+        :return: str filename
+        """
+        filename = self.create_filename(start_time)
+        segment_index.begin(filename, start_time)
+
+        return filename
+
+    def finalize_segment(self, filename: str, start_time: datetime, frames: int, duration: float = None) -> None:
+        """
+        Переименование '.partial' файла в итоговый (атомарно),
+        запись в индекс времени окончания, количества кадров и размера сегмента
+        """
+        filepath = os.path.join(self.media_path, filename)
+        if os.path.exists(self.partial_path(filename)):
+            os.replace(self.partial_path(filename), filepath)
+        size = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+        if duration is None:
+            duration = frames / self.fps
+        segment_index.add(filename,
+                          start_time=start_time,
+                          finish_time=start_time + timedelta(seconds=duration),
+                          frames=frames,
+                          size=size)
+        self.frames_recorded.inc(frames)
+        self.segments_recorded.inc()
+        self.complete_segment(filename)
+
+    def complete_segment(self, filename: str) -> None:
+        """ Удаление сегмента из журнала записываемых файлов """
+        segment_index.finish(filename)
+
     def record_video(self) -> str:
         """
         Запись одного видеофайла
         :return: str filename
         """
         # формирования строки с датой для названия видеофайла
-        filename = self.create_filename()
-
-        # создание экземпляра обьекта записи видео
-        command = ['ffmpeg',
-                   '-y',  # (optional) overwrite output file if it exists
-                   '-f', 'rawvideo',
-                   '-vcodec', 'rawvideo',
-                   '-s', f'{self.width}x{self.height}',  # size of one frame
-                   '-pix_fmt', 'bgr24',
-                   '-r', '15',  # frames per second
-                   '-i', '-',  # The input comes from a pipe
-                   '-an',  # Tells FFMPEG not to expect any audio
-                   '-c:v', 'mpeg4',
-                   '-b:v', '1M',
-                   '-movflags', 'frag_keyframe+empty_moov',  # will cause output to be 100% fragmented
-                   f'{os.path.join(self.media_path, filename)}']
-
-        with subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
-
-            # считывание кадров из rtsp стрима
-            for _ in range(self.total_frames):
-                status, frame = self.capture.read()
-                if status:
-                    process.stdin.write(frame.tobytes())
-                else:
-                    break
-
+        start_time = datetime.now()
+        filename = self.start_segment(start_time)
+        frames = 0
+        dropped_before = self.frame_buffer.dropped
+
+        # создание экземпляра обьекта записи видео (в '.partial' файл до окончания записи)
+        command = build_encoder_command(self.width, self.height, self.fps, self.encoder_profile,
+                                        self.partial_path(filename))
+
+        try:
+            with subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+
+                # считывание кадров из rtsp стрима
+                for _ in range(self.total_frames):
+                    status, frame = self.read()
+                    if status:
+                        self.write_frame(process, frame)
+                        frames += 1
+                    else:
+                        break
+        finally:
+            # записанная часть сохраняется и при ошибке, иначе файл остается '.partial' в журнале
+            self.finalize_segment(filename, start_time, frames)
+        self.log_dropped_frames(dropped_before)
         self.logger.info(f'file "{filename}" has been recorded')
 
         return filename
@@ -99,8 +260,9 @@ class CamRecorder(threading.Thread):
     def run(self):
         """
         Запуск бесконечного цикла записи видео.
-        Если rtsp недоступен, повторная попытка начала записи производится через 30 секунд.
+        Если rtsp недоступен, первая попытка переподключения - сразу, следующие - с растущей задержкой.
         """
+        check_unfinished_records(self.camera_name)  # сегменты, не завершенные предыдущим запуском
         self.logger.info('start recording...')
         while True:
             try:
@@ -108,87 +270,177 @@ class CamRecorder(threading.Thread):
                     self.record_video()
 
             except RTSPError as error:
-                self.logger.warning(error)
-                sleep(30)
+                self.release_capture()
+                self.reconnector.failed(error)
 
             except Exception as error:
                 self.logger.warning(f'Unexpected recorder error: {error}')
-                self.capture.release()
-                sleep(30)
-                self.capture = cv2.VideoCapture(self.url)
+                self.release_capture()
+                self.reconnector.failed(error)
 
 
 class ArUcoCamRecorder(CamRecorder):
+    """
+    Запись, пока в кадре нет маркеров ArUco и машина на погрузке (или нет связи с сервером).
+    Кадры непрерывно кодируются в mpegts, последние Config.PREROLL_SECONDS хранятся в памяти
+    (закодированными) и записываются в начало сегмента, когда запись разрешается.
+    """
     def __init__(self, url: str, camera_name: str, video_loop_size: timedelta, media_path, fps):
         super().__init__(url, camera_name, video_loop_size, media_path, fps)
 
         self.check_interval_in_seconds = Config.CHECK_MARKERS_INTERVAL
-        self.aruco_dictionary = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_250)
-        self.aruco_params = cv2.aruco.DetectorParameters_create()
-
-    def detect_markers(self, frame) -> bool:
-        """ Поиск маркеров ArUco в изображении """
-        _, markers, _ = cv2.aruco.detectMarkers(frame,
-                                                self.aruco_dictionary,
-                                                parameters=self.aruco_params)
-
-        if markers is not None:
-            return False
-
-        return True
+        detect_latency = metrics.histogram('aruco_detect_seconds',
+                                           'Time from frame submit to ArUco detection result')
+        self.detector = MarkerDetector(scale=Config.ARUCO_DETECT_SCALE,
+                                       roi=Config.ARUCO_ROI.get(self.camera_name),
+                                       latency=detect_latency.labels(camera=self.camera_name))
+        self.preroll = PrerollBuffer(Config.PREROLL_SECONDS, Config.PREROLL_MAX_BYTES)
+        self.encoder = None  # постоянный энкодер в mpegts, сегменты записываются из его вывода
+        self.encoder_reader = None
+        self.recording = False  # запись продолжается - следующий сегмент без проверки условий
+        metrics.gauge('recorder_preroll_bytes', 'Encoded video in pre-roll buffer').labels(
+            camera=self.camera_name).set_function(lambda: self.preroll.size)
+
+    def start_capture(self) -> None:
+        super().start_capture()
+        self.start_encoder()
+
+    def release_capture(self) -> None:
+        super().release_capture()
+        self.stop_encoder()
+        self.recording = False
+
+    def start_encoder(self) -> None:
+        """ Запуск энкодера, вывод которого читается в буфер предзаписи """
+        self.stop_encoder()
+        command = build_stream_encoder_command(self.width, self.height, self.fps, self.encoder_profile)
+        self.encoder = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        self.encoder_reader = threading.Thread(target=self.read_encoder, args=(self.encoder,),
+                                               name=f'{self.camera_name}Preroll', daemon=True)
+        self.encoder_reader.start()
+
+    def read_encoder(self, encoder: subprocess.Popen) -> None:
+        while True:
+            data = encoder.stdout.read1(2 ** 16)
+            if not data:
+                break
+            self.preroll.feed(data)
+
+    def stop_encoder(self) -> None:
+        if self.encoder is None:
+            return
+        try:
+            self.encoder.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.encoder.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.encoder.kill()
+            self.encoder.wait()
+        self.encoder_reader.join(timeout=5)
+        self.encoder = None
+        self.preroll.reset()
+
+    @staticmethod
+    def recording_blocked() -> bool:
+        """
+        Запись запрещена: связь с сервером есть, а статус погрузки выключен
+        (флаги читаются из памяти процесса, без запросов к redis)
+        """
+        return bool(state_cache.get(NETWORK_CONNECTION) and not state_cache.get(LOADING_STATUS))
 
-    def initial_check(self) -> bool:
+    def wait_for_gate(self) -> bool:
         """
-        Дополнительная проверка для исключения ложных срабатываний
-        :return: bool
+        Кадры кодируются в буфер предзаписи, пока запись не разрешена:
+        машина на погрузке и маркеры не найдены в 5 проверках подряд
+        (пока запись запрещена, маркеры не ищутся)
+        :return: False если стрим прервался
         """
-        if redis_client.get(NETWORK_CONNECTION) and not redis_client.get(LOADING_STATUS):
-            self.logger.info(f'!!!!!!!!!! loading: False!')
-            return False
-        for _ in range(5):
-            status, frame = self.capture.read()
-            if not status or not self.detect_markers(frame):
-                self.logger.info(f'!!!!!!! status: {status}, markers: {self.detect_markers(frame)}')
+        clean_checks = 0
+        i = 0
+        while clean_checks < 5:
+            status, frame = self.read()
+            if not status:
                 return False
+            self.write_frame(self.encoder, frame)
+            markers = self.detector.poll()
+            if self.recording_blocked():
+                clean_checks = 0
+                i = 0
+                continue
+            if markers is not None:
+                clean_checks = 0 if markers else clean_checks + 1
+            # проверка один раз в заданное количество секунд, первая - сразу после снятия блокировки
+            if not i % (self.fps * self.check_interval_in_seconds):
+                self.detector.submit(frame)
+            i += 1
 
         return True
 
+    def complete_segment(self, filename: str) -> None:
+        """ Файл добавляется в очередь на выгрузку до удаления из журнала """
+        upload_queue.put(filename)
+        super().complete_segment(filename)
+
     def record_video(self) -> str:
         """
-        Запись одного видеофайла
+        Запись одного видеофайла: начало - из буфера предзаписи, дальше кадры по мере кодирования.
+        Если запись не прервана (маркеры, конец погрузки), файл заканчивается перед ключевым кадром,
+        с которого начинается следующий
         :return: str filename
         """
-        # формирования строки с датой для названия видеофайла
-        filename = self.create_filename()
-
-        # создание экземпляра обьекта записи видео
-        command = ['ffmpeg',
-                   '-y',  # (optional) overwrite output file if it exists
-                   '-f', 'rawvideo',
-                   '-vcodec', 'rawvideo',
-                   '-s', f'{self.width}x{self.height}',  # size of one frame
-                   '-pix_fmt', 'bgr24',
-                   '-r', '15',  # frames per second
-                   '-i', '-',  # The input comes from a pipe
-                   '-an',  # Tells FFMPEG not to expect any audio
-                   '-c:v', 'mpeg4',
-                   '-b:v', '1M',
-                   '-movflags', 'frag_keyframe+empty_moov',  # will cause output to be 100% fragmented
-                   f'{os.path.join(self.media_path, filename)}']
-
-        with subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
-
-            for i in range(self.total_frames):
-                record_status, frame = self.capture.read()
-                if record_status:
-                    # проверка один раз в заданное количество секунд
-                    if i and not i % (self.fps * self.check_interval_in_seconds):
-                        if not self.detect_markers(frame):
+        preroll = self.preroll.buffered_seconds()
+        start_time = datetime.now() - timedelta(seconds=preroll)
+        filename = self.start_segment(start_time)
+        dropped_before = self.frame_buffer.dropped
+        continued = self.recording
+        self.recording = False
+
+        try:
+            # энкодер уже работает - в файл ('.partial' до окончания записи) пакеты копируются без перекодирования
+            with subprocess.Popen(build_remux_command(self.partial_path(filename)),
+                                  stdin=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+                try:
+                    self.preroll.attach(process.stdin)
+                    if not continued:
+                        self.logger.info(f'no markers, recording started ({preroll:.1f} s from pre-roll buffer)')
+
+                    for i in range(max(self.total_frames - int(preroll * self.fps), 1)):
+                        record_status, frame = self.read()
+                        if not record_status:
                             break
-                        if redis_client.get(NETWORK_CONNECTION) and not redis_client.get(LOADING_STATUS):
+                        # результат поиска маркеров приходит асинхронно, запись кадров не ждет его
+                        if self.detector.poll():
+                            self.logger.info('markers found, recording stopped')
                             break
-                    process.stdin.write(frame.tobytes())
-
+                        if self.recording_blocked():
+                            self.logger.info('loading status is off, recording stopped')
+                            break
+                        # проверка один раз в заданное количество секунд
+                        if i and not i % (self.fps * self.check_interval_in_seconds):
+                            self.detector.submit(frame)
+                        self.write_frame(self.encoder, frame)
+                    else:
+                        self.recording = True
+
+                    if self.recording:
+                        # кадры кодируются дальше, пока не придет ключевой кадр - начало следующего сегмента
+                        self.preroll.detach(at_keyframe=True)
+                        while not self.preroll.detached.is_set():
+                            record_status, frame = self.read()
+                            if not record_status:
+                                self.recording = False
+                                break
+                            self.write_frame(self.encoder, frame)
+                finally:
+                    self.preroll.detach()
+        finally:
+            # записанная часть сохраняется и при ошибке, иначе файл остается '.partial' в журнале
+            duration = self.preroll.written_seconds(self.fps)
+            self.finalize_segment(filename, start_time, int(duration * self.fps), duration)
+        self.log_dropped_frames(dropped_before)
         self.logger.info(f'file "{filename}" has been recorded')
 
         return filename
@@ -196,24 +448,189 @@ class ArUcoCamRecorder(CamRecorder):
     def run(self):
         """
         Запуск бесконечного цикла записи видео.
-        Если rtsp недоступен, повторная попытка начала записи производится через 30 секунд.
+        Условия записи проверяются непрерывно, запись начинается с буфера предзаписи.
+        Если rtsp недоступен, первая попытка переподключения - сразу, следующие - с растущей задержкой.
         """
+        check_unfinished_records(self.camera_name)  # сегменты, не завершенные предыдущим запуском
         self.logger.info('start recording...')
         while True:
             try:
-                if self.check_capture() and self.initial_check():
-                    filename = self.record_video()
-                    if filename:
-                        redis_client.rpush(READY_TO_UPLOAD, filename)
-                else:
-                    sleep(30)
+                if self.recording or (self.check_capture() and self.wait_for_gate()):
+                    self.record_video()
             except RTSPError as error:
-                self.logger.warning(error)
-                sleep(30)
-                self.capture = cv2.VideoCapture(self.url)
+                self.release_capture()
+                self.reconnector.failed(error)
 
             except Exception as error:
                 self.logger.exception(f'Unexpected recorder error: {error}')
-                self.capture.release()
-                sleep(30)
-                self.capture = cv2.VideoCapture(self.url)
+                self.release_capture()
+                self.reconnector.failed(error)
+
+
+class StreamCopyCamRecorder(CamRecorder):
+    """
+    Запись без декодирования и перекодирования:
+    один процесс ffmpeg читает rtsp стрим и режет его на сегменты (-f segment, -c copy),
+    камера не переподключается между сегментами. Python следит за процессом
+    и завершает сегменты по списку готовых файлов (-segment_list).
+    """
+    def watch_process(self, process: subprocess.Popen, progress: dict) -> None:
+        """
+        Остановка ffmpeg, если прогресс записи не обновлялся дольше Config.FRAME_READ_TIMEOUT
+        (первый кадр ожидается дольше - еще Config.RTSP_OPEN_TIMEOUT на подключение)
+        """
+        while process.poll() is None:
+            if time() - progress['time'] > Config.FRAME_READ_TIMEOUT:
+                progress['stalled'] = True
+                # по SIGTERM ffmpeg закрывает текущий сегмент и дописывает его в список
+                process.terminate()
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                return
+            sleep(0.5)
+
+    def build_command(self, list_path: str) -> List[str]:
+        """
+        ffmpeg: rtsp стрим без перекодирования в сегменты по Config.VIDEO_DURATION,
+        сегмент пишется в '.partial' файл, имя - время открытия файла (как у create_filename)
+        :return: list
+        """
+        return ['ffmpeg',
+                '-y',
+                '-nostats',
+                '-rtsp_transport', 'tcp',
+                '-i', self.url,
+                '-map', '0:v',  # только видео (формат не определяется по расширению '.partial')
+                '-c:v', 'copy',  # без перекодирования
+                '-f', 'segment',
+                '-segment_time', str(self.total_frames // self.fps),  # длительность сегмента в секундах
+                '-segment_format', 'mp4',
+                # фрагменты сразу пишутся в файл: при остановке ffmpeg (kill) записанное не теряется
+                '-segment_format_options', 'movflags=frag_keyframe+empty_moov:flush_packets=1',
+                '-reset_timestamps', '1',  # каждый сегмент начинается с нулевого времени
+                '-segment_list', list_path,
+                '-segment_list_type', 'csv',  # строка "имя,начало,конец" пишется, когда сегмент закончен
+                '-strftime', '1',
+                '-progress', 'pipe:1',  # прогресс записи (out_time_us=, progress=) в stdout
+                self.partial_path(f'{Config.DATETIME_FORMAT}_{self.filename}')]
+
+    @staticmethod
+    def read_segment_list(segment_list: TextIO) -> List[Tuple[str, float]]:
+        """ :return: [(filename, duration)] of segments, which ffmpeg finished since previous call """
+        segments = []
+        while True:
+            position = segment_list.tell()
+            line = segment_list.readline()
+            if not line.endswith('\n'):
+                segment_list.seek(position)  # строка еще дописывается
+                return segments
+            name, start, end = line.strip().rsplit(',', 2)
+            segments.append((os.path.basename(name)[:-len(PARTIAL_SUFFIX)], float(end) - float(start)))
+
+    def find_segment(self, since: datetime) -> Optional[str]:
+        """
+        Сегмент, который ffmpeg пишет сейчас: '.partial' файл, открытый не раньше since
+        (перебираются имена по секундам, без чтения директории)
+        :return: filename or None
+        """
+        moment = datetime.now().replace(microsecond=0)
+        while moment >= since:
+            filename = self.create_filename(moment)
+            if os.path.exists(self.partial_path(filename)):
+                return filename
+            moment -= timedelta(seconds=1)
+
+        return None
+
+    def complete_segments(self, segment_list: TextIO) -> List[str]:
+        """
+        Переименование и добавление в индекс сегментов, которые ffmpeg закончил
+        :return: filenames
+        """
+        filenames = []
+        for filename, duration in self.read_segment_list(segment_list):
+            self.finalize_segment(filename, clip_start_time(filename), round(duration * self.fps), duration)
+            self.logger.info(f'file "{filename}" has been recorded')
+            filenames.append(filename)
+
+        return filenames
+
+    def record_video(self) -> Optional[str]:
+        """
+        Запись сегментов одним процессом ffmpeg, пока стрим не прервется.
+        Записываемый сегмент находится в журнале, законченный - переименовывается и добавляется в индекс.
+        :return: str filename of the last recorded segment
+        """
+        list_path = temp_file('.csv')
+        position = 0  # время записанного стрима, мкс (frame= для -c copy не выводится)
+        current = None  # сегмент, который записывается (в журнале)
+        since = datetime.now().replace(microsecond=0)
+        recorded = []
+
+        progress = {'time': time() + Config.RTSP_OPEN_TIMEOUT, 'stalled': False}
+        try:
+            with subprocess.Popen(self.build_command(list_path), stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, universal_newlines=True) as process, \
+                    open(list_path) as segment_list:
+                watchdog = threading.Thread(target=self.watch_process, args=(process, progress), daemon=True)
+                watchdog.start()
+                for line in process.stdout:
+                    key, _, value = line.strip().partition('=')
+                    if key == 'out_time_us' and value.isdigit() and int(value) > position:
+                        if not position:
+                            self.reconnector.succeeded()  # стрим идет с первого прогресса, не с конца сегмента
+                        position = int(value)
+                        progress['time'] = time()
+                    elif key == 'progress' and position:
+                        # конец блока прогресса (раз в 0.5 с): законченные сегменты и начало следующего
+                        finished = self.complete_segments(segment_list)
+                        if finished:
+                            recorded += finished
+                            since = datetime.now().replace(microsecond=0) - timedelta(seconds=2)
+                            if current in finished:
+                                current = None
+                        if current is None:
+                            current = self.find_segment(since)
+                            if current is not None:
+                                segment_index.begin(current, clip_start_time(current))
+                watchdog.join()
+                process.wait()
+                # последний сегмент: ffmpeg записал его в список при завершении
+                recorded += self.complete_segments(segment_list)
+        finally:
+            if current is None or current in recorded:
+                current = self.find_segment(since)
+                if current is not None:
+                    segment_index.begin(current, clip_start_time(current))
+            # сегмент без строки в списке (ffmpeg убит, ошибка) завершается по журналу, пустой - удаляется
+            check_unfinished_records(self.camera_name)
+            os.remove(list_path)
+
+        if not position:
+            # ffmpeg не получил ни одного кадра - rtsp недоступен
+            raise RTSPError(False, process.returncode == 0)
+        if progress['stalled']:
+            self.logger.info(f'no frames for {Config.FRAME_READ_TIMEOUT} s, stream is stalled')
+            raise RTSPError(False, True)
+
+        return recorded[-1] if recorded else None
+
+    def run(self):
+        """
+        Запуск бесконечного цикла записи видео.
+        Если rtsp недоступен, первая попытка переподключения - сразу, следующие - с растущей задержкой.
+        """
+        check_unfinished_records(self.camera_name)  # сегменты, не завершенные предыдущим запуском
+        self.logger.info('start recording (stream copy)...')
+        while True:
+            try:
+                self.record_video()
+
+            except RTSPError as error:
+                self.reconnector.failed(error)
+
+            except Exception as error:
+                self.logger.warning(f'Unexpected recorder error: {error}')
+                self.reconnector.failed(error)
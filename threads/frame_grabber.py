@@ -0,0 +1,39 @@
+import threading
+
+from utils.error import RTSPError
+from utils.frame_buffer import FrameRingBuffer
+
+
+class FrameGrabber(threading.Thread):
+    """ Чтение кадров из rtsp стрима в кольцевой буфер, независимо от записи видео """
+    def __init__(self, capture, frame_buffer: FrameRingBuffer, camera_name: str):
+        super().__init__(name=f'FrameGrabber-{camera_name}', daemon=True)
+        self.capture = capture
+        self.frame_buffer = frame_buffer
+        self.running = True
+
+    def stop(self) -> None:
+        self.running = False
+        self.frame_buffer.close()
+
+    def run(self) -> None:
+        error = None
+        try:
+            while self.running:
+                index = self.frame_buffer.acquire()
+                if index is None:
+                    break
+
+                # кадр читается сразу в буфер слота, без выделения памяти
+                status, frame = self.capture.read(self.frame_buffer.slots[index])
+                if not status or not self.running:
+                    self.frame_buffer.cancel(index)
+                    if not status:
+                        error = RTSPError(status, self.capture.isOpened())
+                    break
+
+                self.frame_buffer.commit(index, frame)
+        except Exception as exception:
+            error = exception
+        finally:
+            self.frame_buffer.close(error)
@@ -6,8 +6,7 @@ from time import sleep
 from datetime import datetime
 from typing import Dict
 
-from utils.redis_client import redis_client_pickle
-from utils.variables import COORDINATES
+from utils.redis_client import coordinates_queue
 from logs.logger import Logger
 
 
@@ -39,7 +38,7 @@ class GPSEmulator(threading.Thread):
         while True:
             try:
                 coords = self.get_coordinates()
-                redis_client_pickle.rpush(COORDINATES, pickle.dumps(coords))
+                coordinates_queue.put(pickle.dumps(coords))
 
                 sleep(120)
             except Exception as error:
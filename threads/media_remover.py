@@ -1,52 +1,139 @@
 import os
 from threading import Thread
 from time import sleep
-from datetime import timedelta
-from typing import List
+from typing import Callable, Set
 
 from logs.logger import Logger
 from config import Config
 from utils.utils import get_free_space
+from utils.redis_client import upload_queue
+from utils.segment_index import segment_index
+from utils.metrics import metrics
 
 
 class MediaRemover(Thread):
-    def __init__(self, check_interval=3600, min_free_space=10, media_path='media'):
+    """
+    Retention of recorded segments.
+    When free space on media volume drops below min_free_space (high watermark),
+    the oldest segments are removed until target_free_space (low watermark) is reached.
+    Segments of cameras from Config.CAMERA_QUOTAS are also limited by size.
+    Segments in upload queue and segments which are still recorded are kept.
+    """
+    def __init__(self, check_interval=30, min_free_space=10, target_free_space=15, media_path='media'):
         super().__init__()
         self.check_interval = check_interval
         self.min_free_space = min_free_space  # Gb
-        self.num_files_to_delete = int(timedelta(hours=1) / Config.VIDEO_DURATION) * 4
+        self.target_free_space = target_free_space  # Gb
         self.media_path = media_path
+        self.batch_size = 100
         self.logger = Logger('MediaRemover')
 
-    def get_files_to_delete(self) -> List[str]:
+        self.removed_files = metrics.counter('media_removed_files_total', 'Removed segments').labels()
+        self.removed_bytes = metrics.counter('media_removed_bytes_total', 'Bytes freed by removing segments').labels()
+        metrics.gauge('media_free_space_gb', 'Free space on media volume, Gb').labels().set_function(
+            lambda: get_free_space(self.media_path))
+        camera_size = metrics.gauge('media_camera_bytes', 'Total size of camera segments')
+        for camera_name in [cam[1] for cam in Config.CAMERAS + Config.ARUCO_CAMERAS]:
+            camera_size.labels(camera=camera_name).set_function(
+                lambda name=camera_name: segment_index.camera_size(name))
+
+    def get_protected_files(self) -> Set[str]:
         """
-        :return: list of files to delete
+        :return: set of files, which are waiting for upload
         """
-        files = os.listdir(self.media_path)
-        files.sort()
-        return files[:self.num_files_to_delete]
+        return set(upload_queue.items())
 
-    def delete_files(self, files: List[str]) -> None:
+    def delete_file(self, file: str) -> int:
         """
-        Remove files from given list
-        :param files: list
+        Remove file and its segment from index
+        :return: freed bytes
         """
-        for file in files:
-            os.remove(os.path.join(self.media_path, file))
+        segment = segment_index.get(file)
+        path = os.path.join(self.media_path, file)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
             self.logger.info(f'{file} has been removed')
+        except FileNotFoundError:
+            size = 0
+            self.logger.info(f'{file} already removed')
+        segment_index.remove(file)
+
+        size = size or (segment['size'] if segment else 0)
+        self.removed_files.inc()
+        self.removed_bytes.inc(size)
+
+        return size
+
+    def delete_oldest(self, is_done: Callable[[], bool], protected: Set[str], camera_name=None) -> int:
+        """
+        Remove oldest finished segments (of all cameras or of camera_name), which are not protected,
+        one by one until is_done() returns True
+        :return: freed bytes
+        """
+        freed = 0
+        offset = 0
+        while not is_done():
+            files = segment_index.oldest(self.batch_size, camera_name, offset)
+            if not files:
+                break
+            for file in files:
+                segment = segment_index.get(file)
+                if file in protected or (segment and segment['finish_time'] is None):
+                    offset += 1  # файл остается в индексе, следующая пачка начинается после него
+                    continue
+                freed += self.delete_file(file)
+                if is_done():
+                    break
+
+        return freed
+
+    def apply_camera_quotas(self, protected: Set[str]) -> None:
+        """ Remove oldest segments of cameras, which exceed their quota """
+        for camera_name, quota in Config.CAMERA_QUOTAS.items():
+            quota_bytes = int(quota * 2 ** 30)
+
+            def quota_reached() -> bool:
+                return segment_index.camera_size(camera_name) <= quota_bytes
+
+            if not quota_reached():
+                freed = self.delete_oldest(quota_reached, protected, camera_name=camera_name)
+                self.logger.info(f'{camera_name} quota exceeded: {freed / 2 ** 20:.1f} Mb removed')
+
+    def apply_watermarks(self, protected: Set[str]) -> None:
+        """ Remove oldest segments, until free space is target_free_space """
+        free_space = get_free_space(self.media_path)
+        if free_space > self.min_free_space:
+            return
+
+        self.logger.info(f'Low disk space: {free_space:.2f} Gb! Removing older files...')
+
+        def target_reached() -> bool:
+            return get_free_space(self.media_path) >= self.target_free_space
+
+        # очередь могла пополниться после начала прохода
+        freed = self.delete_oldest(target_reached, protected | self.get_protected_files())
+        if not target_reached():
+            # оставшиеся файлы ждут выгрузки и не удаляются
+            self.logger.warning(f'Not enough space, {len(upload_queue)} files are waiting for upload! '
+                                f'Free space: {get_free_space(self.media_path):.2f} Gb')
+
+        self.logger.info(f'{freed / 2 ** 20:.1f} Mb removed, free space: {get_free_space(self.media_path):.2f} Gb')
 
     def run(self) -> None:
         """
         Run media remover thread
         """
+        try:
+            segment_index.recount_sizes()
+        except Exception as error:
+            self.logger.exception(f'Unable to recount segment sizes: {error}')
+
         while True:
             try:
-                free_space = get_free_space()
-                if free_space <= 10:
-
-                    self.logger.info(f'Low disk space: {free_space:.2f} Gb! Removing older files...')
-                    files_to_delete = self.get_files_to_delete()
-                    self.delete_files(files_to_delete)
+                protected = self.get_protected_files()
+                self.apply_camera_quotas(protected)
+                self.apply_watermarks(protected)
             except Exception as error:
                 self.logger.exception(f'Unexpected error: {error}')
             sleep(self.check_interval)
@@ -0,0 +1,48 @@
+import multiprocessing
+from threading import Thread
+from time import sleep
+from typing import Dict, Type
+
+from threads.cam_recorder import CamRecorder
+from utils.metrics import metrics
+from logs.logger import Logger, log_queue, send_to_parent
+
+
+def run_recorder(recorder_class: Type[CamRecorder], recorder_kwargs: Dict, logs: multiprocessing.Queue) -> None:
+    """ Точка входа процесса камеры: рекордер работает в основном потоке процесса """
+    send_to_parent(logs)  # логи пишет основной процесс, в один файл с ротацией
+    # метрики процесса камеры попадают на http endpoint основного процесса через redis
+    metrics.start(f'recorder-{recorder_kwargs["camera_name"]}')
+    recorder = recorder_class(**recorder_kwargs)
+    recorder.run()
+
+
+class RecorderProcess(Thread):
+    """
+    Run camera recorder in separate process (own GIL),
+    restart process if it crashes
+    """
+    def __init__(self, recorder_class: Type[CamRecorder], restart_delay=10, **recorder_kwargs):
+        super().__init__()
+        self.recorder_class = recorder_class
+        self.recorder_kwargs = recorder_kwargs
+        self.restart_delay = restart_delay
+        self.camera_name = recorder_kwargs['camera_name']
+        self.context = multiprocessing.get_context('spawn')
+        self.logger = Logger(f'RecorderProcess {self.camera_name}')
+        self.logs = log_queue()
+
+    def run(self) -> None:
+        """ Run process and wait for it, restart after crash """
+        while True:
+            try:
+                process = self.context.Process(target=run_recorder,
+                                               args=(self.recorder_class, self.recorder_kwargs, self.logs),
+                                               name=f'Recorder-{self.camera_name}')
+                process.start()
+                self.logger.info(f'started, pid: {process.pid}')
+                process.join()
+                self.logger.warning(f'process exited with code {process.exitcode}, restarting...')
+            except Exception as error:
+                self.logger.exception(f'Unexpected error: {error}')
+            sleep(self.restart_delay)
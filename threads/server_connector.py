@@ -1,21 +1,25 @@
 import os
 import threading
 import pickle
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
 from datetime import datetime, timedelta
-from typing import List, Dict
+from typing import List, Dict, Set, Tuple
 
-import paramiko
 from paramiko.sftp_client import SFTPClient
 from paramiko.ssh_exception import SSHException
 from psycopg2 import OperationalError
 from psycopg2 import IntegrityError
-from utils.redis_client import redis_client, redis_client_pickle
-from utils.utils import get_duration, ping_server, extract_datetime, merge_clips, get_clips_by_name, \
-    get_self_ip
+from utils.redis_client import redis_client, upload_queue, requested_files_queue, requests_queue, \
+    coordinates_queue
+from utils.utils import get_duration, ping_server, extract_datetime, merge_clips_concurrently, get_clips_by_name, \
+    merged_clip_name, merged_clip_start, get_self_ip
 from utils.db import DBConnect
-from utils.variables import READY_TO_UPLOAD, READY_REQUESTED_FILES, COORDINATES, REQUESTS, LOADING_STATUS, \
-    NETWORK_CONNECTION
+from utils.sftp_uploader import SFTPUploader
+from utils.segment_index import segment_index
+from utils.state_cache import state_cache
+from utils.metrics import metrics
+from utils.variables import LOADING_STATUS, NETWORK_CONNECTION, CONNECTOR_EVENTS
 from config import Config
 from logs.logger import Logger
 
@@ -34,8 +38,19 @@ class HomeServerConnector(threading.Thread):
         self.password = password
         self.destination_path = destination_path
         self.network_status = 1
+        self.uploader = SFTPUploader(url, username, password)
+        # подписка сразу при создании, чтобы не пропустить события до запуска потока
+        self.events = redis_client.pubsub(CONNECTOR_EVENTS)
         self.logger = Logger('HomeServerConnector')
 
+        # длина очередей считается только при сборе метрик
+        queue_length = metrics.gauge('queue_length', 'Items in redis queue')
+        for queue in (upload_queue, requested_files_queue, requests_queue, coordinates_queue):
+            queue_length.labels(queue=queue.key).set_function(queue.__len__)
+        self.uploaded_bytes = metrics.counter('upload_bytes_total', 'Bytes uploaded to storage server').labels()
+        self.upload_speed = metrics.gauge('upload_speed_mb_per_second', 'Upload speed of last cycle, MB/s').labels()
+        self.upload_failures = metrics.counter('upload_failures_total', 'Files returned to queue').labels()
+
     def set_self_status(self):
         if self.network_status:
             ip_address = get_self_ip()
@@ -44,39 +59,46 @@ class HomeServerConnector(threading.Thread):
                 loading_status = conn.get_loading_status()
                 conn.set_last_seen(ip_address)
 
-            redis_client.set(LOADING_STATUS, loading_status)
+            state_cache.set(LOADING_STATUS, loading_status)
 
     def check_connection(self) -> None:
         """ Set network_status parameter """
         self.network_status = ping_server(Config.STORAGE_SERVER_URL)
-        redis_client.set(NETWORK_CONNECTION, self.network_status)
+        state_cache.set(NETWORK_CONNECTION, self.network_status)
 
     def check_destination_path(self, sftp_client: SFTPClient) -> None:
         """
-        Check if remote path exists,
+        Check if remote path (and temp folder for regular uploads) exists,
         create folder if not
         :param sftp_client:
         """
-        try:
-            sftp_client.stat(self.destination_path)
-        except FileNotFoundError:
-            self.logger.warning('Destination path doesnt exist!')
-            sftp_client.mkdir(self.destination_path)
+        for path in (self.destination_path, Config.DESTINATION_TEMP):
+            try:
+                sftp_client.stat(path)
+            except FileNotFoundError:
+                self.logger.warning(f'Destination path {path} doesnt exist!')
+                sftp_client.mkdir(path)
 
-    def upload_regular_file(self, sftp: SFTPClient) -> None:
-        """ Upload files that should be upload regularly """
-        # получение имени файла из очереди в redis
-        filename = redis_client.get_full_list(READY_TO_UPLOAD)[0]
+    def upload_regular_file(self, sftp: SFTPClient, filename: str) -> int:
+        """
+        Upload files that should be upload regularly
+        :return: uploaded bytes
+        """
         filepath = os.path.join(Config.MEDIA_PATH, filename)
+        uploaded = 0
         try:
             # отправка файла на удаленный сервер
             self.logger.info(f'{filename} - start upload')
 
             start_time = datetime.strptime(extract_datetime(filename), Config.DATETIME_FORMAT)
-            duration = get_duration(filename)
+            segment = segment_index.get(filename)
+            if segment and segment['finish_time']:
+                duration = (segment['finish_time'] - segment['start_time']).total_seconds()
+            else:
+                duration = get_duration(filename)
             if duration:
                 finish_time = start_time + timedelta(seconds=int(duration))
-                sftp.put(filepath, os.path.join(Config.DESTINATION_TEMP, filename))
+                uploaded = self.uploader.put(sftp, filepath, os.path.join(Config.DESTINATION_TEMP, filename))
                 # подключение к базе данных
                 with DBConnect(Config.DATABASE_URL, Config.CAR_LICENSE_TABLE) as conn:
                     # запись данных о видео в удаленную бд
@@ -84,39 +106,110 @@ class HomeServerConnector(threading.Thread):
                                     start_time=start_time,
                                     finish_time=finish_time)
             else:
-                self.logger.warning(f'Corrupt file {filename}')
+                # файл без видео удаляется: после удаления из индекса его не удалил бы и MediaRemover
+                self.logger.warning(f'Corrupt file {filename}, removed')
+                os.remove(filepath)
                 raise FileNotFoundError
 
-        except FileNotFoundError:
-            redis_client.lpop(READY_TO_UPLOAD)
+        except FileNotFoundError as error:
+            if os.path.exists(filepath):
+                # нет пути на сервере - файл остается в очереди и выгружается позже
+                self.logger.exception(f'Some error occurred, {filename} not uploaded: {error}')
+                raise
+            # локального файла нет - сегмент удаляется из очереди и индекса
+            upload_queue.ack(filename)
+            segment_index.remove(filename)
         except (OSError, EOFError) as error:
             self.logger.exception(f'Some error occurred, {filename} not uploaded: {error}')
+            raise
         else:
-            # удаление выгруженного файла из памяти и очереди в redis
+            # удаление выгруженного файла из памяти, индекса и очереди в redis
             os.remove(filepath)
-            redis_client.lpop(READY_TO_UPLOAD)
+            segment_index.remove(filename)
+            upload_queue.ack(filename)
             self.logger.info(f'{filename} - upload complete')
 
-    def upload_requested_files(self, sftp: SFTPClient) -> None:
-        """Upload files that should be upload on request"""
-        # получение имени файлов из очереди в redis
-        request = pickle.loads(redis_client_pickle.get_full_list(READY_REQUESTED_FILES)[0])
+        return uploaded
+
+    def upload_worker(self, failed: Set[str], stop: threading.Event) -> int:
+        """
+        Upload regular files from redis queue over own SFTP channel
+        :return: uploaded bytes
+        """
+        uploaded = 0
+        with self.uploader.open_sftp() as sftp:
+            while not stop.is_set():
+                filename = upload_queue.get()
+                if filename is None:
+                    break
+                try:
+                    uploaded += self.upload_regular_file(sftp, filename)
+                except Exception as error:
+                    # файл остается в списке обработки до конца выгрузки
+                    failed.add(filename)
+                    if isinstance(error, (OSError, EOFError)) and self.uploader.is_connected():
+                        continue
+                    # соединение с сервером или бд потеряно - остальные потоки тоже останавливаются
+                    stop.set()
+                    raise
+
+        return uploaded
+
+    def upload_regular_files(self) -> None:
+        """
+        Upload whole READY_TO_UPLOAD backlog (including files added during upload)
+        in parallel SFTP channels over one SSH transport
+        """
+        start = time()
+        queued = len(upload_queue)
+        failed = set()
+        stop = threading.Event()
+        uploaded = 0
+        try:
+            with ThreadPoolExecutor(max_workers=Config.UPLOAD_WORKERS) as executor:
+                futures = [executor.submit(self.upload_worker, failed, stop)
+                           for _ in range(Config.UPLOAD_WORKERS)]
+            for future in futures:
+                uploaded += future.result()
+        finally:
+            # невыгруженные файлы возвращаются в начало очереди
+            for filename in failed:
+                upload_queue.requeue(filename)
+
+            elapsed = max(time() - start, 0.001)
+            self.uploaded_bytes.inc(uploaded)
+            self.upload_failures.inc(len(failed))
+            self.upload_speed.set(uploaded / 2 ** 20 / elapsed)
+            self.logger.info(f'{queued} files in queue, {len(failed)} failed, '
+                             f'{uploaded / 2 ** 20:.1f} MB uploaded in {elapsed:.0f} s '
+                             f'({uploaded / 2 ** 20 / elapsed:.2f} MB/s)')
+
+    def upload_requested_files(self, sftp: SFTPClient, raw_request: bytes) -> bool:
+        """
+        Upload files that should be upload on request
+        :return: False if upload failed (request is returned to queue)
+        """
+        request = pickle.loads(raw_request)
         pk = request['request_pk']
         files = request['files']
         try:
-            for filename in files:
+            for file in files:
+                if isinstance(file, str):
+                    # запрос из очереди предыдущей версии - только имя файла
+                    file = {'file': file,
+                            'start_time': datetime.strptime(extract_datetime(file), Config.DATETIME_FORMAT)}
+                filename = file['file']
                 filepath = os.path.join(Config.TEMP_PATH, filename)
 
                 # отправка файла на удаленный сервер
                 self.logger.info(f'{filename} - start upload')
-                sftp.put(filepath, os.path.join(Config.DESTINATION_REQUEST, filename))
-                start_time = datetime.strptime(extract_datetime(filename), Config.DATETIME_FORMAT)
+                self.uploader.put(sftp, filepath, os.path.join(Config.DESTINATION_REQUEST, filename))
 
                 # подключение к базе данных
                 with DBConnect(Config.DATABASE_URL, Config.CAR_LICENSE_TABLE) as conn:
                     # запись данных о видео в удаленную бд
                     conn.add_record(filename=filename,
-                                    start_time=start_time,
+                                    start_time=file['start_time'],
                                     finish_time=None,
                                     pk=pk)
 
@@ -125,21 +218,28 @@ class HomeServerConnector(threading.Thread):
 
         except FileNotFoundError:
             self.logger.warning('Not found file to upload')
-            redis_client_pickle.lpop(READY_REQUESTED_FILES)
+            requested_files_queue.ack(raw_request)
         except IntegrityError as error:
             self.logger.info(f'error {error}')
-            redis_client_pickle.lpop(READY_REQUESTED_FILES)
+            requested_files_queue.ack(raw_request)
         except (OSError, EOFError) as error:
             self.logger.exception(f'Some error occurred, request {pk} files not uploaded: {error}')
+            requested_files_queue.requeue(raw_request)
+            return False
+        except Exception:
+            requested_files_queue.requeue(raw_request)
+            raise
         else:
-            # удаление выгруженного файла из памяти и очереди в redis
-            redis_client_pickle.lpop(READY_REQUESTED_FILES)
-
             with DBConnect(Config.DATABASE_URL, Config.CAR_LICENSE_TABLE) as conn:
                 # запись данных о видео в удаленную бд
                 status = bool(files)
                 conn.set_request_status(pk=pk, status=status)
 
+            # удаление запроса из очереди в redis
+            requested_files_queue.ack(raw_request)
+
+        return True
+
     def upload_logs(self, sftp: SFTPClient) -> None:
         try:
             local_logs_path = os.path.join(Config.PATH, 'logs', 'data', 'logs.log')
@@ -154,48 +254,47 @@ class HomeServerConnector(threading.Thread):
         Выгрузка файлов на сервер с помощью SFTP
         Запись данных о файлах в удаленную базу данных
         """
-        # создание SSH подключения
-
-        if redis_client.len(READY_TO_UPLOAD) or redis_client.len(READY_REQUESTED_FILES):
-            with paramiko.SSHClient() as client:
-                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                client.connect(hostname=self.url,
-                               username=self.username,
-                               password=self.password,
-                               auth_timeout=30,
-                               timeout=30,
-                               banner_timeout=30)
-
-                # создание sftp поверх ssh
-                with client.open_sftp() as sftp:
-                    sftp.get_channel().settimeout(30)
-                    sftp.chdir(Config.DESTINATION_DISK)
-
-                    self.check_destination_path(sftp)
-                    self.upload_logs(sftp)
-                    for _ in range(redis_client.len(READY_TO_UPLOAD)):
-                        self.upload_regular_file(sftp)
-                    for _ in range(redis_client.len(READY_REQUESTED_FILES)):
-                        self.upload_requested_files(sftp)
+        if len(upload_queue) or len(requested_files_queue):
+            # SSH подключение сохраняется между циклами
+            self.uploader.connect()
+
+            # создание sftp поверх ssh
+            with self.uploader.open_sftp() as sftp:
+                self.check_destination_path(sftp)
+                self.upload_logs(sftp)
+
+            self.upload_regular_files()
+
+            with self.uploader.open_sftp() as sftp:
+                for _ in range(len(requested_files_queue)):
+                    raw_request = requested_files_queue.get()
+                    if raw_request is None or not self.upload_requested_files(sftp, raw_request):
+                        break
 
     def send_coordinates(self) -> None:
         """Отправка координат в удаленную базу данных"""
         # подключение к базе данных
+        if not len(coordinates_queue):
+            return
+
         with DBConnect(Config.DATABASE_URL, Config.CAR_LICENSE_TABLE) as conn:
-            if redis_client.len(COORDINATES):
-                for _ in range(redis_client.len(COORDINATES)):
-                    try:
-                        # получение и десериализация координат из очереди redis
-                        coordinates = pickle.loads(redis_client_pickle.get_full_list(COORDINATES)[0])
-                        # отправка координат в бд
-                        conn.add_coordinates(coordinates)
-                    except Exception as error:
-                        self.logger.exception(f'Some error occurred, coordinates not uploaded: {error}')
-                    else:
-                        # удаление координат из очереди redis
-                        redis_client_pickle.lpop(COORDINATES)
-
-                self.logger.info('coordinates upload complete')
+            while True:
+                # получение координат из очереди redis
+                raw_coordinates = coordinates_queue.get()
+                if raw_coordinates is None:
+                    break
+                try:
+                    # десериализация и отправка координат в бд
+                    conn.add_coordinates(pickle.loads(raw_coordinates))
+                except Exception as error:
+                    self.logger.exception(f'Some error occurred, coordinates not uploaded: {error}')
+                    coordinates_queue.requeue(raw_coordinates)
+                    break
+                else:
+                    # удаление координат из очереди redis
+                    coordinates_queue.ack(raw_coordinates)
+
+            self.logger.info('coordinates upload complete')
 
     def check_video_requests(self) -> None:
         """
@@ -206,68 +305,88 @@ class HomeServerConnector(threading.Thread):
             # получение запросов на видеозаписи
             requests = conn.get_record_requests()
             for request in requests:
-                redis_client_pickle.lpush(REQUESTS, pickle.dumps(request))
+                requests_queue.put(pickle.dumps(request))
 
     def create_clips_by_request(self) -> None:
         """
         Create clips, for request
         Push clips names to redis queue
         """
-        for _ in range(redis_client_pickle.len(REQUESTS)):
+        for _ in range(len(requests_queue)):
             # Получение запроса
-            request = pickle.loads(redis_client_pickle.lpop(REQUESTS))
-            clips = self.find_clips_by_request(request)
-            camera_names = [cam[1] for cam in Config.CAMERAS]
-
-            request_files = []
-            for camera_name in camera_names:
-                camera_clips = get_clips_by_name(clips, camera_name)
-                if camera_clips:
-                    request_files.append(merge_clips(camera_clips))
+            raw_request = requests_queue.get()
+            if raw_request is None:
+                break
+            request = pickle.loads(raw_request)
+            try:
+                clips = self.find_clips_by_request(request)
+                camera_names = [cam[1] for cam in Config.CAMERAS]
+                start_time, finish_time = self.get_request_window(request)
+
+                # выгружается только запрошенный отрезок, а не сегменты целиком
+                jobs = [get_clips_by_name(clips, camera_name) for camera_name in camera_names]
+                suffix = f'request{request["id"]}'
+                # начало клипа - ключевой кадр до start_time, а не начало первого сегмента
+                clip_starts = {merged_clip_name(job, start_time, finish_time, suffix):
+                               merged_clip_start(job, start_time) for job in jobs if job}
+                request_files = [{'file': filename, 'start_time': clip_starts[filename]}
+                                 for filename in merge_clips_concurrently(jobs, start_time, finish_time, suffix)]
+            except Exception:
+                requests_queue.requeue(raw_request)
+                raise
 
             result_dict = {
                 'request_pk': request['id'],
                 'files': request_files,
             }
 
-            redis_client_pickle.lpush(READY_REQUESTED_FILES, pickle.dumps(result_dict))
+            requested_files_queue.put(pickle.dumps(result_dict))
+            requests_queue.ack(raw_request)
+
+    @staticmethod
+    def get_request_window(request: Dict) -> Tuple[datetime, datetime]:
+        """ :return: (start_time, finish_time) of request in local time without tzinfo """
+        return request['start_time'].replace(tzinfo=None), request['finish_time'].replace(tzinfo=None)
 
     def find_clips_by_request(self, request: Dict) -> List[str]:
         """ Find clips, which are suitable to request """
+        start_time, finish_time = self.get_request_window(request)
 
-        filenames = os.listdir(Config.MEDIA_PATH)
-
-        request_files = []
-        start_time = request['start_time'].replace(tzinfo=None)
-        finish_time = request['finish_time'].replace(tzinfo=None)
+        return segment_index.find(start_time, finish_time)
 
-        for filename in filenames:
-
-            # Парсинг имени файла
-            file_start = datetime.strptime(extract_datetime(filename), Config.DATETIME_FORMAT)
-            duration = int(get_duration(filename))
-            if not duration:
-                continue
-            file_finish = file_start + timedelta(seconds=duration)
-
-            # Проверка видео, подходит ли оно под запрос и формирование видео
-            if file_start <= start_time <= file_finish and file_start <= finish_time <= file_finish:
-                request_files.append(filename)
-            elif start_time <= file_start and file_finish <= finish_time:
-                request_files.append(filename)
-            elif file_start <= start_time <= file_finish:
-                request_files.append(filename)
-            elif file_start <= finish_time <= file_finish:
-                request_files.append(filename)
-
-        return request_files
+    def wait_for_events(self, timeout: float) -> None:
+        """
+        Wait for new work (message in CONNECTOR_EVENTS channel: new segment, coordinates,
+        network is up) or timeout
+        """
+        deadline = time() + timeout
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return
+            message = self.events.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message:
+                break
+
+        # события, пришедшие одновременно, обрабатываются за один цикл
+        while self.events.get_message(ignore_subscribe_messages=True, timeout=0.1):
+            pass
+
+    def recover_queues(self) -> None:
+        """ Return items, which were in processing before restart, to queues """
+        for queue in (upload_queue, requested_files_queue, requests_queue, coordinates_queue):
+            recovered = queue.recover()
+            if recovered:
+                self.logger.info(f'{recovered} items returned to queue "{queue.key}"')
 
     def run(self):
         """
         Запуск бесконечного цикла.
         Попытка выгрузки файлов и координат в каждой итерации.
-        В случае неудачи следущая попытка осуществляется через (хронометраж видео).
+        Следующая итерация начинается по событию из redis (новый файл, координаты, появилась сеть)
+        или, если событий нет, через Config.CONNECTOR_FALLBACK_INTERVAL.
         """
+        self.recover_queues()
 
         while True:
             try:
@@ -282,4 +401,9 @@ class HomeServerConnector(threading.Thread):
                 self.logger.info(f"Unable to connect: {error}")
             except Exception as error:
                 self.logger.exception(f"Unexpected error: {error}")
-            sleep(Config.VIDEO_DURATION.total_seconds())
+
+            try:
+                self.wait_for_events(Config.CONNECTOR_FALLBACK_INTERVAL)
+            except Exception as error:
+                self.logger.exception(f"Unable to wait for events: {error}")
+                sleep(Config.CONNECTOR_FALLBACK_INTERVAL)
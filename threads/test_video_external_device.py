@@ -1,12 +1,15 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
-from time import sleep
-from threading import Thread
-from typing import List
+from time import sleep, time
+from threading import Thread, Lock
+from typing import List, Iterator, Optional
 
 import psutil
 
-from utils.utils import get_duration, merge_clips, get_clips_by_name
+from utils.utils import merge_clips_concurrently, get_clips_by_name, copy_file, media_file_path
+from utils.segment_index import segment_index
+from utils.metrics import metrics
 from config import Config
 from logs.logger import Logger
 
@@ -17,8 +20,15 @@ class ExportMovieToExternalDrive(Thread):
         self.check_interval = timedelta(minutes=1)
         self.disk_partitions = psutil.disk_partitions()
         self.new_device = None
+        self.progress_lock = Lock()
+        self.bytes_exported = 0
         self.logger = Logger('exporter')
 
+        self.exported_bytes = metrics.counter('export_bytes_total', 'Bytes exported to flash drives').labels()
+        self.export_speed = metrics.gauge('export_speed_mb_per_second', 'Speed of last export, MB/s').labels()
+        self.export_time = metrics.histogram('export_seconds', 'Duration of export to flash drive',
+                                             buckets=(10, 30, 60, 120, 300, 600, 1200)).labels()
+
     def check_new_partitions(self) -> None:
         """
         Check for new partition
@@ -35,55 +45,158 @@ class ExportMovieToExternalDrive(Thread):
         self.disk_partitions = partitions
 
     def upload_latest_files_to_external_device(self) -> None:
-        """ Upload files, which contains last 20 minutes, to external device """
-        files = self.create_clips_for_export()
-        for file in files:
-            with open(os.path.join(self.new_device.mountpoint, file), 'wb') as out_file:
-                with open(os.path.join(Config.TEMP_PATH, file), 'rb') as input_file:
-                    for line in input_file:
-                        out_file.write(line)
-            os.remove(os.path.join(Config.TEMP_PATH, file))
-        self.logger.info('Files exported to flash drive!')
-
-    def create_clips_for_export(self) -> List[str]:
-        """ Find clips, which contains last 20 minutes and merge them """
+        """
+        Upload files, which contains last 20 minutes, to external device.
+        Config.EXPORT_MODE:
+            'merge' - clips are merged in TEMP_PATH and copied to device (several files at once)
+            'direct' - ffmpeg writes merged clips straight to device
+            'segments' - segments are copied as is, with playlist
+        """
+        self.logger.notify('Выгрузка записей на флешку...')
+        self.bytes_exported = 0
+        start = time()
+        if Config.EXPORT_MODE == 'direct':
+            exported = self.export_direct()
+        elif Config.EXPORT_MODE == 'segments':
+            exported = self.export_segments()
+        else:
+            exported = self.export_merged()
+
+        # запись метаданных каталога (новые файлы) на флешку
+        directory_fd = os.open(self.new_device.mountpoint, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(directory_fd)
+
+        elapsed = time() - start
+        megabytes = sum(exported) / 2 ** 20
+        self.exported_bytes.inc(sum(exported))
+        self.export_speed.set(megabytes / elapsed)
+        self.export_time.observe(elapsed)
+        self.logger.notify(f'Files exported to flash drive! {len(exported)} files, {megabytes:.1f} MB, '
+                           f'{megabytes / elapsed:.1f} MB/s')
+
+    def export_merged(self) -> List[int]:
+        """
+        Every merged file is copied as soon as it is ready
+        :return: sizes of exported files
+        """
+        with ThreadPoolExecutor(max_workers=Config.EXPORT_WORKERS, thread_name_prefix='export') as executor:
+            futures = [executor.submit(self.copy_to_device, file) for file in self.create_clips_for_export()]
+            return [future.result() for future in futures]
 
+    def export_direct(self) -> List[int]:
+        """
+        Merge clips straight to device (no copy in TEMP_PATH)
+        :return: sizes of exported files
+        """
+        exported = []
+        for filename in self.create_clips_for_export(output_dir=self.new_device.mountpoint):
+            path = os.path.join(self.new_device.mountpoint, filename)
+            file_size = self.sync_file(path)
+            if not file_size:
+                raise IOError(f'empty file in export! {filename}')
+            self.update_progress(file_size)
+            exported.append(file_size)
+
+        return exported
+
+    def export_segments(self) -> List[int]:
+        """
+        Copy segments without merging, playlist 'export.m3u' plays them in order by camera
+        :return: sizes of exported files
+        """
         clips = self.find_clips_for_export()
         camera_names = [cam[1] for cam in Config.CAMERAS] + [cam[1] for cam in Config.ARUCO_CAMERAS]
-        request_files = [merge_clips(get_clips_by_name(clips, camera_name)) for camera_name in camera_names]
+        playlist = [clip for camera_name in camera_names for clip in get_clips_by_name(clips, camera_name) or []]
 
-        return request_files
+        with ThreadPoolExecutor(max_workers=Config.EXPORT_WORKERS, thread_name_prefix='export') as executor:
+            futures = [executor.submit(self.copy_to_device, clip, media_file_path(clip), False) for clip in playlist]
+            exported = [future.result() for future in futures]
 
-    def find_clips_for_export(self) -> List[str]:
-        """ Find clips, which are suitable to request """
-        finish_time = datetime.now()
-        start_time = finish_time - timedelta(minutes=20)
+        playlist_path = os.path.join(self.new_device.mountpoint, 'export.m3u')
+        with open(playlist_path, 'w') as playlist_file:
+            playlist_file.write('#EXTM3U\n')
+            for clip in playlist:
+                playlist_file.write(f'{clip}\n')
+        self.sync_file(playlist_path)
 
-        # Получение списка записанных файлов
-        filenames = os.listdir(Config.MEDIA_PATH)
+        return exported
 
-        request_files = []
-        for filename in filenames:
+    @staticmethod
+    def sync_file(path: str) -> int:
+        """
+        Flush file to device
+        :return: file size
+        """
+        file_fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(file_fd)
+        finally:
+            os.close(file_fd)
 
-            # Парсинг имени файла
-            file_start = datetime.strptime(filename[:19], Config.DATETIME_FORMAT)
-            duration = get_duration(filename)
-            if not duration:
-                continue
+        return os.path.getsize(path)
 
-            file_finish = file_start + timedelta(seconds=duration)
+    def copy_to_device(self, filename: str, source_path: Optional[str] = None, remove_source: bool = True) -> int:
+        """
+        Copy file (from Config.TEMP_PATH by default) to device, fsync and check size
+        :return: file size
+        """
+        source_path = source_path or os.path.join(Config.TEMP_PATH, filename)
+        destination_path = os.path.join(self.new_device.mountpoint, filename)
+        # последний сегмент может еще записываться - копируется только уже записанная часть
+        file_size = os.path.getsize(source_path)
+        start = time()
+
+        with open(source_path, 'rb') as input_file, open(destination_path, 'wb') as out_file:
+            copy_file(input_file, out_file, self.update_progress, file_size)
+            out_file.flush()
+            # данные должны быть на флешке до того, как водитель ее извлечет
+            os.fsync(out_file.fileno())
+
+        copied_size = os.path.getsize(destination_path)
+        if copied_size != file_size:
+            raise IOError(f'size mismatch in export! {filename}: {copied_size} != {file_size}')
+        if remove_source:
+            os.remove(source_path)
+
+        elapsed = time() - start
+        self.logger.info(f'"{filename}" exported: {file_size / 2 ** 20:.1f} MB, '
+                         f'{file_size / 2 ** 20 / elapsed:.1f} MB/s')
+
+        return file_size
+
+    def update_progress(self, copied: int) -> None:
+        """ Log total exported size every Config.EXPORT_PROGRESS_STEP bytes """
+        step = Config.EXPORT_PROGRESS_STEP
+        with self.progress_lock:
+            before = self.bytes_exported
+            self.bytes_exported += copied
+            if before // step != self.bytes_exported // step:
+                self.logger.info(f'exported {self.bytes_exported / 2 ** 20:.0f} MB')
+
+    def create_clips_for_export(self, output_dir: Optional[str] = None) -> Iterator[str]:
+        """
+        Find clips, which contains last 20 minutes and merge them
+        :param output_dir: directory of merged files (Config.TEMP_PATH by default)
+        :return: iterator over merged files in order of completion
+        """
 
-            # Проверка видео, подходит ли оно под запрос и формирование клипов
-            if file_start <= start_time <= file_finish and file_start <= finish_time <= file_finish:
-                request_files.append(filename)
-            elif start_time <= file_start and file_finish <= finish_time:
-                request_files.append(filename)
-            elif file_start <= start_time <= file_finish:
-                request_files.append(filename)
-            elif file_start <= finish_time <= file_finish:
-                request_files.append(filename)
+        clips = self.find_clips_for_export()
+        camera_names = [cam[1] for cam in Config.CAMERAS] + [cam[1] for cam in Config.ARUCO_CAMERAS]
+        jobs = [get_clips_by_name(clips, camera_name) for camera_name in camera_names]
+
+        return merge_clips_concurrently(jobs, suffix='export', output_dir=output_dir)
+
+    def find_clips_for_export(self) -> List[str]:
+        """ Find clips, which are suitable to request """
+        finish_time = datetime.now()
+        start_time = finish_time - timedelta(minutes=20)
 
-        return request_files
+        return segment_index.find(start_time, finish_time)
 
     def run(self):
         """ Run thread """
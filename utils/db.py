@@ -1,35 +1,109 @@
 import datetime
+import os
+import pickle
+import threading
+from time import perf_counter
 
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import Session
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, MetaData
+
+from utils.metrics import metrics
+from config import Config
+
+
+TABLES = ('car', 'record', 'request', 'gps')
+
+# общие для процесса engine (с пулом соединений), отображенные классы и запись машины
+_engines = {}
+_classes = {}
+_cars = {}
+_lock = threading.Lock()
+
+
+def get_engine(db_url):
+    """ One engine with connection pool per process """
+    with _lock:
+        if db_url not in _engines:
+            _engines[db_url] = create_engine(
+                db_url,
+                connect_args={"options": "-c timezone=utc"},
+                pool_size=Config.DB_POOL_SIZE,
+                pool_recycle=Config.DB_POOL_RECYCLE,
+                pool_pre_ping=Config.DB_POOL_PRE_PING,
+            )
+        return _engines[db_url]
+
+
+def load_metadata(engine) -> MetaData:
+    """
+    Reflected schema, cached to disk between restarts
+    (delete Config.DB_SCHEMA_CACHE after schema migration)
+    """
+    if os.path.exists(Config.DB_SCHEMA_CACHE):
+        try:
+            with open(Config.DB_SCHEMA_CACHE, 'rb') as file:
+                metadata = pickle.load(file)
+            if all(table in metadata.tables for table in TABLES):
+                return metadata
+        except Exception:
+            pass
+
+    metadata = MetaData()
+    metadata.reflect(engine, only=TABLES)
+    with open(Config.DB_SCHEMA_CACHE, 'wb') as file:
+        pickle.dump(metadata, file)
+
+    return metadata
+
+
+def get_classes(db_url):
+    """ automap classes, prepared once per process """
+    engine = get_engine(db_url)
+    with _lock:
+        if db_url not in _classes:
+            Base = automap_base(metadata=load_metadata(engine))
+            Base.prepare()
+            _classes[db_url] = Base.classes
+        return _classes[db_url]
+
+
+# время работы с бд за одно подключение (запросы и commit)
+db_session_time = metrics.histogram('db_session_seconds', 'Time of DBConnect session with remote database').labels()
 
 
 class DBConnect:
     def __init__(self, db_url, license_table):
-        """prepare and automap db"""
+        """prepare and automap db (once per process)"""
 
-        Base = automap_base()
-        self._engine = create_engine(
-            db_url,
-            connect_args={"options": "-c timezone=utc"}
-        )
-        Base.prepare(self._engine, reflect=True)
+        self._engine = get_engine(db_url)
+        classes = get_classes(db_url)
 
-        self._Car = Base.classes.car
+        self._Car = classes.car
+        self._car_key = (db_url, license_table)
         self.license_table = license_table
-        self.Record = Base.classes.record
-        self.RecordRequest = Base.classes.request
-        self.GPS = Base.classes.gps
+        self.Record = classes.record
+        self.RecordRequest = classes.request
+        self.GPS = classes.gps
 
     def __enter__(self):
+        self.started_at = perf_counter()
         self.session = Session(self._engine)
-        self.car = self.session.query(self._Car).filter_by(license_table=self.license_table).first()
+
+        # запись машины запрашивается один раз, дальше копируется в сессию без запроса к бд
+        car = _cars.get(self._car_key)
+        if car is None:
+            car = self.session.query(self._Car).filter_by(license_table=self.license_table).first()
+            if car is not None:
+                self.session.expunge(car)
+                _cars[self._car_key] = car
+        self.car = self.session.merge(car, load=False) if car is not None else None
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.session.close()
+        db_session_time.observe(perf_counter() - self.started_at)
 
     def add_record(self, filename, start_time, finish_time, pk=None):
         """ Добавить запись в базу данных """
@@ -76,4 +150,6 @@ class DBConnect:
         self.session.commit()
 
     def get_loading_status(self):
+        # статус загрузки меняется на сервере, поэтому перечитывается
+        self.session.refresh(self.car)
         return self.car.loading
@@ -0,0 +1,89 @@
+from typing import Dict, List
+
+from config import Config
+
+# типы записей mp4 (stsd), которые пишет ffmpeg для кодеков профилей
+CODEC_SAMPLE_ENTRIES = {
+    'mpeg4': {'mp4v'},
+    'libx264': {'avc1', 'avc3'},
+    'libx265': {'hev1', 'hvc1'},
+}
+
+
+def get_encoder_profile(camera_name: str) -> Dict:
+    """
+    Encoder profile of camera (Config.CAMERA_ENCODER_PROFILES or default Config.ENCODER_PROFILE)
+    :return: dict
+    """
+    profile_name = Config.CAMERA_ENCODER_PROFILES.get(camera_name, Config.ENCODER_PROFILE)
+
+    return Config.ENCODER_PROFILES[profile_name]
+
+
+def encoder_args(profile: Dict, fps: int) -> List[str]:
+    """ ffmpeg output video options for profile """
+    args = ['-c:v', profile['codec']]
+    if profile.get('preset'):
+        args += ['-preset', profile['preset']]
+    if profile.get('crf') is not None:
+        args += ['-crf', str(profile['crf'])]
+    if profile.get('bitrate'):
+        args += ['-b:v', profile['bitrate']]
+    args += ['-g', str(int(fps * profile.get('gop_seconds', 2)))]  # интервал ключевых кадров
+    args += ['-pix_fmt', profile.get('pix_fmt', 'yuv420p')]
+
+    return args
+
+
+def raw_input_args(width: int, height: int, fps: int) -> List[str]:
+    """ ffmpeg input options for raw bgr24 frames from stdin """
+    return ['-f', 'rawvideo',
+            '-vcodec', 'rawvideo',
+            '-s', f'{width}x{height}',  # size of one frame
+            '-pix_fmt', 'bgr24',
+            '-r', str(fps),  # frames per second
+            '-i', '-',  # The input comes from a pipe
+            '-an']  # Tells FFMPEG not to expect any audio
+
+
+def build_encoder_command(width: int, height: int, fps: int, profile: Dict, output_path: str) -> List[str]:
+    """
+    ffmpeg command, which encodes raw bgr24 frames from stdin to fragmented mp4
+    (output_path may have any extension)
+    :return: list
+    """
+    return ['ffmpeg',
+            '-y',  # (optional) overwrite output file if it exists
+            *raw_input_args(width, height, fps),
+            *encoder_args(profile, fps),
+            '-f', 'mp4',  # формат не определяется по расширению '.partial'
+            '-movflags', 'frag_keyframe+empty_moov',  # will cause output to be 100% fragmented
+            output_path]
+
+
+def build_stream_encoder_command(width: int, height: int, fps: int, profile: Dict) -> List[str]:
+    """
+    ffmpeg command, which encodes raw bgr24 frames from stdin to mpegts on stdout
+    (continuous stream, segments are cut from it on keyframes, see utils.preroll)
+    :return: list
+    """
+    return ['ffmpeg',
+            *raw_input_args(width, height, fps),
+            *encoder_args(profile, fps),
+            '-f', 'mpegts',
+            '-']
+
+
+def build_remux_command(output_path: str) -> List[str]:
+    """
+    ffmpeg command, which writes mpegts from stdin to fragmented mp4 without re-encoding
+    :return: list
+    """
+    return ['ffmpeg',
+            '-y',
+            '-f', 'mpegts',
+            '-i', '-',
+            '-c', 'copy',
+            '-f', 'mp4',
+            '-movflags', 'frag_keyframe+empty_moov',
+            output_path]
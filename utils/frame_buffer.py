@@ -0,0 +1,92 @@
+import threading
+from collections import deque
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class FrameRingBuffer:
+    """
+    Fixed-size ring of preallocated frame buffers between capture and encoder.
+    Each slot is in one of states: free -> writing (producer) -> ready -> held (consumer) -> free.
+    The slot returned by get() stays valid until the next get() call.
+    """
+    DROP_OLDEST = 'drop_oldest'
+    BLOCK = 'block'
+
+    def __init__(self, capacity: int, shape: Optional[Tuple[int, int, int]] = None, policy: str = DROP_OLDEST):
+        if capacity < 2:
+            raise ValueError('Frame buffer capacity must be at least 2')
+        if policy not in (self.DROP_OLDEST, self.BLOCK):
+            raise ValueError(f'Unknown frame buffer policy: {policy}')
+
+        self.capacity = capacity
+        self.policy = policy
+        # если размер кадра известен, буферы выделяются сразу, иначе при первом чтении кадра
+        self.slots = [np.empty(shape, dtype=np.uint8) if shape else None for _ in range(capacity)]
+        self.free = deque(range(capacity))
+        self.ready = deque()
+        self.held = None
+        self.closed = False
+        self.error = None
+        self.received = 0
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> Optional[int]:
+        """
+        Get free slot for writing.
+        If there is no free slot, drop the oldest ready frame or wait (depends on policy).
+        :return: slot index or None if buffer is closed
+        """
+        with self.condition:
+            while not self.free and not self.closed:
+                if self.policy == self.DROP_OLDEST and self.ready:
+                    self.free.append(self.ready.popleft())
+                    self.dropped += 1
+                else:
+                    self.condition.wait()
+            if self.closed:
+                return None
+            return self.free.popleft()
+
+    def commit(self, index: int, frame: np.ndarray) -> None:
+        """ Mark slot as ready for encoder """
+        with self.condition:
+            # cv2 выделяет новый массив, если размер кадра не совпал с буфером
+            self.slots[index] = frame
+            self.ready.append(index)
+            self.received += 1
+            self.condition.notify_all()
+
+    def cancel(self, index: int) -> None:
+        """ Return slot without frame """
+        with self.condition:
+            self.free.append(index)
+            self.condition.notify_all()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        """
+        Get next frame. Previous frame returned by get() is released.
+        :return: frame or None if buffer is closed (or timeout expired)
+        """
+        with self.condition:
+            if self.held is not None:
+                self.free.append(self.held)
+                self.held = None
+                self.condition.notify_all()
+
+            if not self.condition.wait_for(lambda: self.ready or self.closed, timeout):
+                return None
+            if not self.ready:
+                return None
+
+            self.held = self.ready.popleft()
+            return self.slots[self.held]
+
+    def close(self, error: Optional[Exception] = None) -> None:
+        """ Close buffer, wake up producer and consumer """
+        with self.condition:
+            self.closed = True
+            self.error = error
+            self.condition.notify_all()
@@ -0,0 +1,144 @@
+import atexit
+import multiprocessing
+import threading
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.pool import AsyncResult
+from time import perf_counter
+from typing import Optional, Tuple, Dict
+
+import cv2
+import numpy as np
+
+from config import Config
+
+
+# состояние процесса пула
+_dictionary = None
+_parameters = None
+_attached: Dict[str, shared_memory.SharedMemory] = {}
+
+# состояние основного процесса
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker() -> None:
+    global _dictionary, _parameters
+    _dictionary = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_250)
+    _parameters = cv2.aruco.DetectorParameters_create()
+
+
+def _detect(shm_name: str, shape: Tuple[int, int]) -> bool:
+    """
+    Search ArUco markers in grayscale frame from shared memory (runs in pool process)
+    :return: True if markers found
+    """
+    shm = _attached.get(shm_name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        # памятью владеет процесс камеры, процесс пула не должен удалять ее при завершении
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        _attached[shm_name] = shm
+
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    _, markers, _ = cv2.aruco.detectMarkers(frame, _dictionary, parameters=_parameters)
+
+    return markers is not None
+
+
+def get_pool() -> multiprocessing.pool.Pool:
+    """ Shared detection pool, created on first use """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            context = multiprocessing.get_context('spawn')
+            _pool = context.Pool(processes=Config.ARUCO_WORKERS, initializer=_init_worker)
+        return _pool
+
+
+class MarkerDetector:
+    """
+    Asynchronous ArUco detection in shared process pool.
+    Frame is cropped to ROI, downscaled and converted to grayscale
+    directly into shared memory, worker process reads it from there.
+    """
+    def __init__(self, scale: float = 1.0, roi: Optional[Tuple[int, int, int, int]] = None, latency=None):
+        self.scale = scale
+        self.roi = roi  # (x, y, width, height) в пикселях исходного кадра
+        self.latency = latency  # гистограмма времени от отправки кадра до результата (utils.metrics)
+        self.shm = None
+        self.shape = None
+        self.pending: Optional[AsyncResult] = None
+        self.submitted_at = 0.0
+        atexit.register(self.close)
+
+    def _prepare(self, frame: np.ndarray) -> Tuple[int, int]:
+        """ Write downscaled grayscale frame to shared memory """
+        if self.roi:
+            x, y, width, height = self.roi
+            frame = frame[y:y + height, x:x + width]
+        if self.scale != 1:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+        shape = frame.shape[:2]
+        if shape != self.shape:
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=shape[0] * shape[1])
+            self.shape = shape
+
+        gray = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+
+        return shape
+
+    def submit(self, frame: np.ndarray) -> bool:
+        """
+        Submit frame for detection without waiting for result
+        :return: False if previous detection is not finished or its result is not taken by poll() yet
+                 (frame skipped, result is not lost)
+        """
+        if self.pending is not None:
+            return False
+
+        self.submitted_at = perf_counter()
+        shape = self._prepare(frame)
+        self.pending = get_pool().apply_async(_detect, (self.shm.name, shape))
+
+        return True
+
+    def poll(self) -> Optional[bool]:
+        """
+        :return: result of just finished detection (True if markers found) or None
+        """
+        if self.pending is None or not self.pending.ready():
+            return None
+
+        pending, self.pending = self.pending, None
+        self.observe_latency()
+        return pending.get()
+
+    def detect(self, frame: np.ndarray, timeout: float = 10) -> bool:
+        """
+        Blocking detection
+        :return: True if markers found
+        """
+        if self.pending is not None:
+            self.pending.wait(timeout)
+        self.pending = None
+        self.submit(frame)
+
+        pending, self.pending = self.pending, None
+        result = pending.get(timeout)
+        self.observe_latency()
+        return result
+
+    def observe_latency(self) -> None:
+        if self.latency is not None:
+            self.latency.observe(perf_counter() - self.submitted_at)
+
+    def close(self) -> None:
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+            self.shape = None
@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep, time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.redis_client import redis_client
+from utils.variables import METRICS
+from config import Config
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def collect(self) -> float:
+        return self.value
+
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """ Value is calculated only when metrics are collected (no cost in hot loops) """
+        self.function = function
+
+    def collect(self) -> float:
+        if self.function is not None:
+            try:
+                self.value = self.function()
+            except Exception:
+                pass
+        return self.value
+
+
+class HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def collect(self) -> Dict:
+        with self.lock:
+            return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class Metric:
+    """
+    Metric family: children with own label values.
+    Children are created once (labels()) and may be updated by several threads
+    (db_session_seconds - by all upload workers), so counters and histograms update under own lock.
+    Gauge is only set, without read-modify-write.
+    """
+    def __init__(self, name: str, kind: str, description: str, child_factory: Callable):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.child_factory = child_factory
+        self.children: Dict[Tuple, object] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, **labels: str):
+        key = tuple(sorted(labels.items()))
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.child_factory())
+        return child
+
+    def collect(self) -> Dict:
+        return {'type': self.kind, 'help': self.description,
+                'samples': [[dict(key), child.collect()] for key, child in list(self.children.items())]}
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms of this process.
+    Snapshot is written to redis hash 'metrics' (field - process name) every
+    Config.METRICS_SNAPSHOT_INTERVAL, main process serves all snapshots in Prometheus text format.
+    """
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+        self.process_name = None
+
+    def _get(self, name: str, kind: str, description: str, child_factory: Callable) -> Metric:
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Metric(name, kind, description, child_factory)
+            return self.metrics[name]
+
+    def counter(self, name: str, description: str) -> Metric:
+        return self._get(name, 'counter', description, CounterChild)
+
+    def gauge(self, name: str, description: str) -> Metric:
+        return self._get(name, 'gauge', description, GaugeChild)
+
+    def histogram(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Metric:
+        return self._get(name, 'histogram', description, lambda: HistogramChild(buckets))
+
+    def collect(self) -> Dict:
+        return {name: metric.collect() for name, metric in list(self.metrics.items())}
+
+    def snapshot(self) -> None:
+        """ Write metrics of this process to redis """
+        redis_client.hset(METRICS, mapping={
+            self.process_name: json.dumps({'time': time(), 'pid': os.getpid(), 'metrics': self.collect()}),
+        })
+
+    def snapshots(self) -> List[Dict]:
+        """ :return: fresh metrics of this process and recent snapshots of other processes """
+        result = [self.collect()]
+        max_age = Config.METRICS_SNAPSHOT_INTERVAL * 3
+        try:
+            raw_snapshots = redis_client.hgetall(METRICS)
+        except Exception:
+            return result  # redis недоступен - только метрики этого процесса
+
+        for process_name, raw_snapshot in raw_snapshots.items():
+            if process_name == self.process_name:
+                continue
+            snapshot = json.loads(raw_snapshot)
+            if time() - snapshot['time'] <= max_age:
+                result.append(snapshot['metrics'])
+
+        return result
+
+    def render(self) -> str:
+        """ Prometheus text exposition format """
+        families = {}
+        for snapshot in self.snapshots():
+            for name, family in snapshot.items():
+                families.setdefault(name, {'type': family['type'], 'help': family['help'], 'samples': []})
+                families[name]['samples'].extend(family['samples'])
+
+        lines = []
+        for name, family in sorted(families.items()):
+            lines.append(f'# HELP {name} {family["help"]}')
+            lines.append(f'# TYPE {name} {family["type"]}')
+            for labels, value in family['samples']:
+                if family['type'] != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(value['buckets'] + ['+Inf'], value['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(dict(labels, le=str(bound)))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value["sum"]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def start(self, process_name: str, serve: bool = False) -> None:
+        """
+        Start snapshots to redis (and HTTP endpoint on Config.METRICS_PORT, if serve)
+        :param process_name: unique name of process ('main', 'recorder-<camera>')
+        """
+        self.process_name = process_name
+        threading.Thread(target=self.snapshot_loop, name='MetricsSnapshot', daemon=True).start()
+        if serve:
+            server = ThreadingHTTPServer((Config.METRICS_HOST, Config.METRICS_PORT), MetricsHandler)
+            threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+
+    def snapshot_loop(self) -> None:
+        while True:
+            sleep(Config.METRICS_SNAPSHOT_INTERVAL)
+            try:
+                self.snapshot()
+            except Exception:
+                pass  # redis недоступен - следующая попытка через интервал
+
+
+def _format_labels(labels: Dict) -> str:
+    if not labels:
+        return ''
+    values = []
+    for key, value in sorted(labels.items()):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        values.append(f'{key}="{escaped}"')
+    return '{' + ','.join(values) + '}'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # запросы не пишутся в stderr
+
+
+metrics = MetricsRegistry()
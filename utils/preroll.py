@@ -0,0 +1,186 @@
+import threading
+from collections import deque
+from typing import BinaryIO, Optional
+
+TS_PACKET_SIZE = 188
+PTS_CLOCK = 90000  # частота timestamp в mpegts
+PTS_WRAP = 2 ** 33
+
+
+def _payload_offset(packet: bytes) -> int:
+    """ Offset of payload in TS packet (after adaptation field) """
+    if packet[3] & 0x20:
+        return 5 + packet[4]
+    return 4
+
+
+def _is_keyframe(packet: bytes) -> bool:
+    """ random_access_indicator: ffmpeg sets it in the first packet of every keyframe """
+    return bool(packet[3] & 0x20 and packet[4] and packet[5] & 0x40)
+
+
+def _pes_pts(packet: bytes) -> Optional[int]:
+    """ PTS of PES, which starts in packet """
+    if not packet[1] & 0x40:
+        return None
+    pes = packet[_payload_offset(packet):]
+    if len(pes) < 14 or pes[:3] != b'\x00\x00\x01' or not pes[7] & 0x80:
+        return None
+
+    return ((pes[9] >> 1) & 0x07) << 30 | pes[10] << 22 | (pes[11] >> 1) << 15 | pes[12] << 7 | pes[13] >> 1
+
+
+class PrerollBuffer:
+    """
+    Last seconds of encoded video (mpegts packets from encoder stdout), grouped by GOP,
+    so that output always starts from keyframe. Memory is limited by max_seconds and max_bytes.
+    While sink (stdin of ffmpeg, which writes segment) is attached, packets are also written to it:
+    attach() flushes buffered GOPs first, so segment starts with video recorded before it.
+    All methods are thread safe: feed() is called by encoder reader thread, others by recorder.
+    """
+    def __init__(self, max_seconds: float, max_bytes: int):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.gops = deque()  # [pts, bytearray] от ключевого кадра до следующего
+        self.size = 0
+        self.tables = {}  # последние PAT и PMT - нужны в начале каждого сегмента
+        self.pmt_pid = None
+        self.remainder = b''
+        self.last_pts = None
+        self.sink: Optional[BinaryIO] = None
+        self.sink_first_pts = None
+        self.sink_last_pts = None
+        self.detach_at_keyframe = False
+        self.detached = threading.Event()
+        self.detached.set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def duration(first_pts: Optional[int], last_pts: Optional[int]) -> float:
+        if first_pts is None or last_pts is None:
+            return 0.0
+        return ((last_pts - first_pts) % PTS_WRAP) / PTS_CLOCK
+
+    def buffered_seconds(self) -> float:
+        """ :return: seconds of video, which attach() will write to sink """
+        with self.lock:
+            return self.duration(self.gops[0][0], self.last_pts) if self.gops else 0.0
+
+    def feed(self, data: bytes) -> None:
+        """ Add encoder output (any chunk size, packets are split by 188 bytes) """
+        data = self.remainder + data
+        end = len(data) - len(data) % TS_PACKET_SIZE
+        self.remainder = data[end:]
+
+        with self.lock:
+            output = bytearray()
+            for start in range(0, end, TS_PACKET_SIZE):
+                packet = data[start:start + TS_PACKET_SIZE]
+                if packet[0] != 0x47:
+                    continue  # поток не выровнен - пакет пропускается
+                pid = (packet[1] & 0x1f) << 8 | packet[2]
+                if pid == 0 or pid == self.pmt_pid:
+                    if pid == 0:
+                        offset = _payload_offset(packet) + 1 + packet[_payload_offset(packet)]
+                        self.pmt_pid = (packet[offset + 10] & 0x1f) << 8 | packet[offset + 11]
+                    self.tables[pid] = packet
+                    continue
+                if pid < 0x20:
+                    continue  # SDT и другие служебные таблицы не нужны
+
+                if _is_keyframe(packet):
+                    if self.sink is not None and self.detach_at_keyframe:
+                        self._write(output)
+                        self._close_sink()
+                        output = bytearray()
+                    self.gops.append([_pes_pts(packet), bytearray()])
+                    self._trim()
+                    if self.sink is not None and self.sink_first_pts is None:
+                        self.sink_first_pts = self.gops[-1][0]  # буфер был пуст при attach()
+                elif not self.gops:
+                    continue  # без ключевого кадра пакеты не декодируются
+
+                pts = _pes_pts(packet)
+                if pts is not None:
+                    self.last_pts = pts
+                    if self.sink is not None:
+                        self.sink_last_pts = pts
+                self.gops[-1][1] += packet
+                self.size += TS_PACKET_SIZE
+                if self.sink is not None:
+                    output += packet
+
+            self._write(output)
+
+    def _trim(self) -> None:
+        """ Remove oldest GOPs beyond limits (current GOP is always kept) """
+        while len(self.gops) > 1 and (self.size > self.max_bytes or
+                                      self.duration(self.gops[0][0], self.gops[-1][0]) > self.max_seconds):
+            self.size -= len(self.gops.popleft()[1])
+
+    def _write(self, data: bytes) -> None:
+        if self.sink is None or not data:
+            return
+        try:
+            self.sink.write(data)
+        except (OSError, ValueError):
+            self._close_sink()  # ffmpeg сегмента завершился
+
+    def _close_sink(self) -> None:
+        """ Close sink; its packets are in segment and are not needed for next one """
+        try:
+            self.sink.close()
+        except (OSError, ValueError):
+            pass
+        self.sink = None
+        self.detach_at_keyframe = False
+        # текущий GOP уже записан не полностью - следующий сегмент начнется со следующего ключевого кадра
+        self.gops.clear()
+        self.size = 0
+        self.detached.set()
+
+    def attach(self, sink: BinaryIO) -> float:
+        """
+        Write tables and buffered GOPs to sink, next packets are written as they come
+        :return: seconds of video written from buffer
+        """
+        with self.lock:
+            self.sink = sink
+            self.sink_first_pts = self.gops[0][0] if self.gops else None
+            self.sink_last_pts = self.last_pts if self.gops else None
+            self.detach_at_keyframe = False
+            self.detached.clear()
+            self._write(b''.join(self.tables.values()) + b''.join(gop for _, gop in self.gops))
+            return self.duration(self.sink_first_pts, self.sink_last_pts)
+
+    def detach(self, at_keyframe: bool = False) -> None:
+        """
+        Close sink now or before next keyframe (segments follow each other without gap,
+        recorder keeps encoding frames until self.detached is set)
+        """
+        with self.lock:
+            if self.sink is None:
+                return
+            if at_keyframe:
+                self.detach_at_keyframe = True
+            else:
+                self._close_sink()
+
+    def written_seconds(self, fps: int) -> float:
+        """ :return: duration of video written to the last sink """
+        with self.lock:
+            if self.sink_first_pts is None:
+                return 0.0
+            return self.duration(self.sink_first_pts, self.sink_last_pts) + 1 / fps
+
+    def reset(self) -> None:
+        """ Encoder restarted: buffered packets and tables are not valid anymore """
+        with self.lock:
+            if self.sink is not None:
+                self._close_sink()
+            self.gops.clear()
+            self.size = 0
+            self.tables = {}
+            self.pmt_pid = None
+            self.remainder = b''
+            self.last_pts = None
@@ -0,0 +1,278 @@
+import os
+import struct
+import subprocess
+from functools import lru_cache
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+# контейнеры, внутри которых лежат нужные боксы
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'mvex', b'moof', b'traf'}
+
+TFHD_DEFAULT_SAMPLE_DURATION = 0x000008
+TRUN_DATA_OFFSET = 0x000001
+TRUN_FIRST_SAMPLE_FLAGS = 0x000004
+TRUN_SAMPLE_DURATION = 0x000100
+TRUN_SAMPLE_SIZE = 0x000200
+TRUN_SAMPLE_FLAGS = 0x000400
+TRUN_SAMPLE_CTO = 0x000800
+
+
+def iter_boxes(file: BinaryIO, start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """
+    Iterate over boxes in [start, end) without reading their payload
+    :return: (box type, payload offset, box end)
+    """
+    offset = start
+    while offset + 8 <= end:
+        file.seek(offset)
+        header = file.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', file.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def _full_box(file: BinaryIO, offset: int) -> Tuple[int, int]:
+    """ :return: (version, flags) of full box """
+    file.seek(offset)
+    version_flags = struct.unpack('>I', file.read(4))[0]
+
+    return version_flags >> 24, version_flags & 0xFFFFFF
+
+
+def _read_media_header(file: BinaryIO, offset: int) -> Tuple[int, int]:
+    """ mvhd/mdhd: :return: (timescale, duration) """
+    version, _ = _full_box(file, offset)
+    if version == 1:
+        file.seek(offset + 4 + 16)
+        return struct.unpack('>IQ', file.read(12))
+    file.seek(offset + 4 + 8)
+    return struct.unpack('>II', file.read(8))
+
+
+def _parse_moov(file: BinaryIO, start: int, end: int) -> Dict:
+    """ Movie timescale/duration, video track id, track timescales, codecs and default sample durations """
+    info = {'timescale': 0, 'duration': 0, 'tracks': {}, 'video_track': None, 'trex': {}}
+
+    def walk(box_start, box_end, track):
+        for box_type, payload, box_end_offset in iter_boxes(file, box_start, box_end):
+            if box_type == b'trak':
+                walk(payload, box_end_offset, {})
+            elif box_type in CONTAINER_BOXES:
+                walk(payload, box_end_offset, track)
+            elif box_type == b'mvhd':
+                info['timescale'], info['duration'] = _read_media_header(file, payload)
+            elif box_type == b'tkhd':
+                version, _ = _full_box(file, payload)
+                file.seek(payload + 4 + (16 if version == 1 else 8))
+                track['id'] = struct.unpack('>I', file.read(4))[0]
+                info['tracks'][track['id']] = track
+            elif box_type == b'mdhd':
+                track['timescale'], track['duration'] = _read_media_header(file, payload)
+            elif box_type == b'hdlr':
+                file.seek(payload + 8)
+                if file.read(4) == b'vide' and info['video_track'] is None:
+                    info['video_track'] = track.get('id')
+            elif box_type == b'stsd':
+                # первая запись описания сэмплов: размер и тип (mp4v, avc1, hev1...)
+                file.seek(payload + 8 + 4)
+                track['codec'] = file.read(4).decode('ascii', 'replace')
+            elif box_type == b'trex':
+                file.seek(payload + 4)
+                track_id, _, default_duration = struct.unpack('>III', file.read(12))
+                info['trex'][track_id] = default_duration
+
+    walk(start, end, {})
+    return info
+
+
+def _parse_moof(file: BinaryIO, start: int, end: int, moov: Dict) -> Optional[Tuple[int, int, int]]:
+    """
+    Start and end time of video track in fragment: baseMediaDecodeTime (+ sum of sample durations)
+    :return: (start time, end time in track timescale, track id) or None
+    """
+    for traf_type, traf_payload, traf_end in iter_boxes(file, start, end):
+        if traf_type != b'traf':
+            continue
+
+        track_id, default_duration, base_time, total_duration = None, None, 0, 0
+        for box_type, payload, _ in iter_boxes(file, traf_payload, traf_end):
+            if box_type == b'tfhd':
+                _, flags = _full_box(file, payload)
+                track_id = struct.unpack('>I', file.read(4))[0]
+                if flags & TFHD_DEFAULT_SAMPLE_DURATION:
+                    # пропуск base_data_offset (0x01) и sample_description_index (0x02)
+                    skip = (8 if flags & 0x000001 else 0) + (4 if flags & 0x000002 else 0)
+                    file.seek(payload + 8 + skip)
+                    default_duration = struct.unpack('>I', file.read(4))[0]
+            elif box_type == b'tfdt':
+                version, _ = _full_box(file, payload)
+                if version == 1:
+                    base_time = struct.unpack('>Q', file.read(8))[0]
+                else:
+                    base_time = struct.unpack('>I', file.read(4))[0]
+            elif box_type == b'trun':
+                _, flags = _full_box(file, payload)
+                sample_count = struct.unpack('>I', file.read(4))[0]
+                if not flags & TRUN_SAMPLE_DURATION:
+                    if default_duration is None:
+                        default_duration = moov['trex'].get(track_id, 0)
+                    total_duration += sample_count * default_duration
+                    continue
+
+                file.seek(payload + 8
+                          + (4 if flags & TRUN_DATA_OFFSET else 0)
+                          + (4 if flags & TRUN_FIRST_SAMPLE_FLAGS else 0))
+                fields = [TRUN_SAMPLE_DURATION, TRUN_SAMPLE_SIZE, TRUN_SAMPLE_FLAGS, TRUN_SAMPLE_CTO]
+                sample_size = 4 * sum(1 for field in fields if flags & field)
+                samples = file.read(sample_count * sample_size)
+                for index in range(len(samples) // sample_size):
+                    total_duration += struct.unpack_from('>I', samples, index * sample_size)[0]
+
+        if moov['video_track'] in (None, track_id):
+            return base_time, base_time + total_duration, track_id
+
+    return None
+
+
+def _read_top_level(file: BinaryIO, size: int) -> Tuple[Optional[Dict], List[Tuple[int, int]]]:
+    """ :return: parsed moov and (payload offset, end) of complete fragments (moof followed by mdat) """
+    moov = None
+    last_moof = None
+    complete_moofs = []
+    for box_type, payload, box_end in iter_boxes(file, 0, size):
+        if box_end > size:
+            break  # недописанный бокс
+        if box_type == b'moov':
+            moov = _parse_moov(file, payload, box_end)
+        elif box_type == b'moof':
+            last_moof = (payload, box_end)
+        elif box_type == b'mdat' and last_moof:
+            complete_moofs.append(last_moof)
+            last_moof = None
+
+    return moov, complete_moofs
+
+
+def _track_timescale(moov: Dict, track_id: int) -> int:
+    return moov['tracks'].get(track_id, {}).get('timescale') or moov['timescale']
+
+
+def read_mp4_duration(path: str) -> Optional[float]:
+    """
+    Duration of mp4 from container timing (mvhd, or tfdt/trun of the last complete fragment)
+    :return: seconds or None if file can't be parsed
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        moov, complete_moofs = _read_top_level(file, size)
+        complete_moof = complete_moofs[-1] if complete_moofs else None
+
+        if moov is None:
+            return None
+
+        if complete_moof is None:
+            if moov['duration'] and moov['timescale']:
+                return moov['duration'] / moov['timescale']
+            return 0.0
+
+        result = _parse_moof(file, *complete_moof, moov)
+        if result is None:
+            return None
+        _, end_time, track_id = result
+        timescale = _track_timescale(moov, track_id)
+        if not timescale:
+            return None
+
+        return end_time / timescale
+
+
+def keyframe_times(path: str) -> List[float]:
+    """
+    Start times of fragments of video track in seconds.
+    Recorders write mp4 with 'frag_keyframe', so every fragment starts with a keyframe.
+    :return: list (empty for not fragmented or corrupt files)
+    """
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as file:
+            moov, complete_moofs = _read_top_level(file, size)
+            if moov is None:
+                return []
+            times = []
+            for moof in complete_moofs:
+                result = _parse_moof(file, *moof, moov)
+                if result is None:
+                    continue
+                start_time, _, track_id = result
+                timescale = _track_timescale(moov, track_id)
+                if timescale:
+                    times.append(start_time / timescale)
+    except (OSError, struct.error):
+        return []
+
+    return times
+
+
+def video_codec(path: str) -> Optional[str]:
+    """
+    Sample entry type of video track (mp4v, avc1, hev1...)
+    :return: str or None if file can't be parsed
+    """
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as file:
+            moov, _ = _read_top_level(file, size)
+    except (OSError, struct.error):
+        return None
+    if moov is None:
+        return None
+
+    return moov['tracks'].get(moov['video_track'], {}).get('codec')
+
+
+def ffprobe_duration(path: str) -> Optional[float]:
+    """ Duration from ffprobe (fallback) """
+    try:
+        output = subprocess.check_output(['ffprobe', '-v', 'error',
+                                          '-show_entries', 'format=duration',
+                                          '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                                         stderr=subprocess.DEVNULL, timeout=30)
+        return float(output.strip())
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+
+@lru_cache(maxsize=4096)
+def _probe_duration(path: str, size: int, mtime: float) -> float:
+    """ Cached by (path, size, mtime): finished segment is probed only once """
+    try:
+        duration = read_mp4_duration(path)
+    except (OSError, struct.error):
+        duration = None
+    if duration is None:
+        duration = ffprobe_duration(path)
+
+    return duration or 0.0
+
+
+def probe_duration(path: str) -> float:
+    """
+    Segment duration in seconds (0 if file is missing or corrupt)
+    :return: float
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return 0.0
+
+    return _probe_duration(path, stat.st_size, stat.st_mtime)
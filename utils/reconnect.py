@@ -0,0 +1,58 @@
+import random
+from time import sleep, time
+from typing import Optional
+
+from logs.logger import Logger
+from utils.metrics import metrics
+from config import Config
+
+
+class Reconnector:
+    """
+    Delays between reconnection attempts to camera.
+    First attempt after failure is immediate, next ones use exponential backoff with jitter
+    (cameras, which rebooted together, don't reconnect at the same moment).
+    Downtime is logged when stream is back.
+    """
+    def __init__(self, logger: Logger, initial_delay: float = None, max_delay: float = None, jitter: float = None):
+        self.logger = logger
+        self.initial_delay = Config.RECONNECT_INITIAL_DELAY if initial_delay is None else initial_delay
+        self.max_delay = Config.RECONNECT_MAX_DELAY if max_delay is None else max_delay
+        self.jitter = Config.RECONNECT_JITTER if jitter is None else jitter
+        self.attempts = 0
+        self.down_since: Optional[float] = None
+        self.reconnects = metrics.counter('recorder_reconnects_total',
+                                          'Reconnection attempts to camera').labels(camera=logger.name)
+        self.downtime = metrics.counter('recorder_downtime_seconds_total',
+                                        'Time without stream from camera').labels(camera=logger.name)
+
+    def next_delay(self) -> float:
+        """ :return: seconds before next attempt """
+        if self.attempts <= 1:
+            return 0.0
+        delay = min(self.max_delay, self.initial_delay * 2 ** (self.attempts - 2))
+
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def failed(self, error: Exception) -> None:
+        """ Register failure and wait before next attempt """
+        if self.down_since is None:
+            self.down_since = time()
+        self.attempts += 1
+        self.reconnects.inc()
+        delay = self.next_delay()
+        if self.attempts == 1:
+            self.logger.warning(f'{error}, reconnecting...')
+        else:
+            self.logger.info(f'{error}, reconnect attempt {self.attempts} in {delay:.1f} s')
+        if delay:
+            sleep(delay)
+
+    def succeeded(self) -> None:
+        """ Stream is back """
+        if self.down_since is not None:
+            downtime = time() - self.down_since
+            self.downtime.inc(downtime)
+            self.logger.warning(f'stream restored after {downtime:.1f} s of downtime ({self.attempts} attempts)')
+        self.attempts = 0
+        self.down_since = None
@@ -1,7 +1,9 @@
-from typing import Union
+from typing import Union, Dict, List, Optional
 
 import redis
 
+from utils.variables import READY_TO_UPLOAD, READY_REQUESTED_FILES, REQUESTS, COORDINATES, CONNECTOR_EVENTS
+
 
 class RedisClient:
     def __init__(self, host: str, db: int):
@@ -11,13 +13,20 @@ class RedisClient:
             decode_responses=True
         )
 
-    def get(self, key: str):
-        value = self.client.get(key)
+    @staticmethod
+    def parse(value):
+        """ Numbers (flags are stored as '1.0'/'0.0') are returned as float, other values as is """
         try:
             return float(value)
-        except ValueError:
+        except (TypeError, ValueError):
             return value
 
+    def get(self, key: str):
+        return self.parse(self.client.get(key))
+
+    def mget(self, keys: List[str]) -> List:
+        return [self.parse(value) for value in self.client.mget(keys)]
+
     def set(self, key: str, value: Union[int, str, bool]):
         if isinstance(value, bool):
             value = float(value)
@@ -44,6 +53,63 @@ class RedisClient:
     def rpush(self, key: str, value: Union[int, str, bool]):
         return self.client.rpush(key, value)
 
+    def lrem(self, key: str, value: Union[int, str, bool], count: int = 1):
+        return self.client.lrem(key, count, value)
+
+    def lmove(self, source: str, destination: str, where_from: str = 'LEFT', where_to: str = 'RIGHT'):
+        return self.client.execute_command('LMOVE', source, destination, where_from, where_to)
+
+    def blmove(self, source: str, destination: str, timeout: float,
+               where_from: str = 'LEFT', where_to: str = 'RIGHT'):
+        return self.client.execute_command('BLMOVE', source, destination, where_from, where_to, timeout)
+
+    def publish(self, channel: str, message: Union[int, str]):
+        return self.client.publish(channel, message)
+
+    def pubsub(self, *channels: str):
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(*channels)
+        return pubsub
+
+    def delete(self, *keys: str):
+        return self.client.delete(*keys)
+
+    def hset(self, key: str, mapping: Dict):
+        return self.client.hset(key, mapping=mapping)
+
+    def hgetall(self, key: str):
+        return self.client.hgetall(key)
+
+    def hget(self, key: str, field: str):
+        return self.client.hget(key, field)
+
+    def zadd(self, key: str, mapping: Dict):
+        return self.client.zadd(key, mapping)
+
+    def zrem(self, key: str, *values: str):
+        return self.client.zrem(key, *values)
+
+    def sadd(self, key: str, *values: str):
+        return self.client.sadd(key, *values)
+
+    def srem(self, key: str, *values: str):
+        return self.client.srem(key, *values)
+
+    def smembers(self, key: str):
+        return self.client.smembers(key)
+
+    def zcard(self, key: str):
+        return self.client.zcard(key)
+
+    def zrange(self, key: str, from_int: int, to_int: int):
+        return self.client.zrange(key, from_int, to_int)
+
+    def zrange_by_score(self, key: str, min_score: float, max_score: float):
+        return self.client.zrangebyscore(key, min_score, max_score)
+
+    def pipeline(self, transaction: bool = True):
+        return self.client.pipeline(transaction=transaction)
+
 
 class RedisClientNoDecode(RedisClient):
     def __init__(self, host: str, db: int):
@@ -54,5 +120,74 @@ class RedisClientNoDecode(RedisClient):
         )
 
 
+class RedisQueue:
+    """
+    Crash-safe queue.
+    get() atomically moves the head item (LMOVE) to the consumer's processing list,
+    where it stays until ack() or requeue(). After crash recover() returns
+    items from processing list back to the head of the queue.
+    All operations are O(1) (ack/requeue - O(size of processing list)).
+    """
+    def __init__(self, client: RedisClient, key: str, consumer: str, channel: Optional[str] = None):
+        self.client = client
+        self.key = key
+        self.processing_key = f'{key}:processing:{consumer}'
+        self.channel = channel  # канал pub/sub, в который сообщается о новом элементе
+
+    def __len__(self) -> int:
+        return self.client.len(self.key)
+
+    def put(self, value: Union[int, str, bytes]) -> None:
+        if self.channel is None:
+            self.client.rpush(self.key, value)
+            return
+
+        pipe = self.client.pipeline()
+        pipe.rpush(self.key, value)
+        pipe.publish(self.channel, self.key)
+        pipe.execute()
+
+    def get(self, timeout: Optional[float] = None):
+        """
+        :param timeout: None - don't wait, 0 - wait forever, otherwise wait up to timeout seconds
+        :return: item or None if queue is empty
+        """
+        if timeout is None:
+            return self.client.lmove(self.key, self.processing_key)
+        return self.client.blmove(self.key, self.processing_key, timeout)
+
+    def ack(self, value: Union[int, str, bytes]) -> None:
+        """ Item is processed, remove it from processing list """
+        self.client.lrem(self.processing_key, value)
+
+    def requeue(self, value: Union[int, str, bytes]) -> None:
+        """ Return item to the head of the queue """
+        pipe = self.client.pipeline()
+        pipe.lrem(self.processing_key, 1, value)
+        pipe.lpush(self.key, value)
+        pipe.execute()
+
+    def recover(self) -> int:
+        """
+        Return items, which were in processing when consumer stopped, to the head of the queue
+        (in the original order)
+        :return: number of recovered items
+        """
+        recovered = 0
+        while self.client.lmove(self.processing_key, self.key, 'RIGHT', 'LEFT') is not None:
+            recovered += 1
+
+        return recovered
+
+    def items(self) -> List:
+        """ All items: queued and in processing """
+        return self.client.get_full_list(self.key) + self.client.get_full_list(self.processing_key)
+
+
 redis_client = RedisClient(host='127.0.0.1', db=0)
 redis_client_pickle = RedisClientNoDecode(host='127.0.0.1', db=0)
+
+upload_queue = RedisQueue(redis_client, READY_TO_UPLOAD, consumer='connector', channel=CONNECTOR_EVENTS)
+requested_files_queue = RedisQueue(redis_client_pickle, READY_REQUESTED_FILES, consumer='connector')
+requests_queue = RedisQueue(redis_client_pickle, REQUESTS, consumer='connector')
+coordinates_queue = RedisQueue(redis_client_pickle, COORDINATES, consumer='connector', channel=CONNECTOR_EVENTS)
@@ -0,0 +1,245 @@
+import os
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Iterable
+
+from utils.redis_client import redis_client, RedisClient, upload_queue
+from utils.utils import extract_datetime, extract_name, get_duration, clip_start_time, PARTIAL_SUFFIX
+from utils.variables import SEGMENTS, SEGMENT, SEGMENT_SIZES, SEGMENT_MAX_DURATIONS, RECORDING
+from config import Config
+
+
+class SegmentIndex:
+    """
+    Index of recorded segments stored in redis.
+    Every segment is a member of two sorted sets scored by start timestamp:
+    common 'segments' (age order) and 'segments:<camera name>' (lookups by camera).
+    Segment metadata (start, end, frames, size) is stored in hash 'segment:<filename>'.
+    Total size of segments of every camera is kept in hash 'segment_sizes' (updated on add/remove).
+    Longest finished segment of every camera is kept in hash 'segment_max_durations':
+    segments end on keyframe and can be longer than max_duration.
+    Segments, which are recorded right now, are also in journal - set 'recording'.
+    """
+    def __init__(self, client: RedisClient, max_duration: timedelta):
+        self.client = client
+        self.max_duration = max_duration.total_seconds()
+
+    @staticmethod
+    def camera_key(camera_name: str) -> str:
+        return f'{SEGMENTS}:{camera_name}'
+
+    @staticmethod
+    def segment_key(filename: str) -> str:
+        return f'{SEGMENT}:{filename}'
+
+    def add(self, filename: str, start_time: datetime, finish_time: Optional[datetime] = None,
+            frames: int = 0, size: int = 0) -> None:
+        """
+        Add or update segment.
+        Segment without finish_time is considered as recording in progress.
+        """
+        score = start_time.timestamp()
+        camera_name = extract_name(filename)
+        previous_size = int(self.client.hget(self.segment_key(filename), 'size') or 0)
+        pipe = self.client.pipeline()
+        pipe.hincrby(SEGMENT_SIZES, camera_name, size - previous_size)
+        if finish_time:
+            duration = finish_time.timestamp() - score
+            if duration > float(self.client.hget(SEGMENT_MAX_DURATIONS, camera_name) or 0):
+                pipe.hset(SEGMENT_MAX_DURATIONS, camera_name, duration)
+        pipe.zadd(SEGMENTS, {filename: score})
+        pipe.zadd(self.camera_key(camera_name), {filename: score})
+        pipe.hset(self.segment_key(filename), mapping={
+            'start': score,
+            'finish': finish_time.timestamp() if finish_time else '',
+            'frames': frames,
+            'size': size,
+        })
+        pipe.execute()
+
+    def begin(self, filename: str, start_time: datetime) -> None:
+        """ Add segment, which recording is started, and write it to journal """
+        self.add(filename, start_time=start_time)
+        self.client.sadd(RECORDING, filename)
+
+    def finish(self, filename: str) -> None:
+        """ Remove segment from journal (file is finished and, if needed, queued for upload) """
+        self.client.srem(RECORDING, filename)
+
+    def recording(self) -> List[str]:
+        """ :return: segments from journal """
+        return sorted(self.client.smembers(RECORDING))
+
+    def remove(self, filename: str) -> None:
+        size = int(self.client.hget(self.segment_key(filename), 'size') or 0)
+        pipe = self.client.pipeline()
+        if size:
+            pipe.hincrby(SEGMENT_SIZES, extract_name(filename), -size)
+        pipe.zrem(SEGMENTS, filename)
+        pipe.zrem(self.camera_key(extract_name(filename)), filename)
+        pipe.delete(self.segment_key(filename))
+        pipe.execute()
+
+    def get(self, filename: str) -> Optional[Dict]:
+        """
+        :return: dict with start_time, finish_time (None if unfinished), frames, size
+        """
+        return self._parse(self.client.hgetall(self.segment_key(filename)))
+
+    def count(self) -> int:
+        return self.client.zcard(SEGMENTS)
+
+    def oldest(self, count: int, camera_name: Optional[str] = None, offset: int = 0) -> List[str]:
+        """ :return: oldest segments (of all cameras or of camera_name) """
+        key = SEGMENTS if camera_name is None else self.camera_key(camera_name)
+        return self.client.zrange(key, offset, offset + count - 1)
+
+    def camera_size(self, camera_name: str) -> int:
+        """ :return: total size of camera segments in bytes """
+        return int(self.client.hget(SEGMENT_SIZES, camera_name) or 0)
+
+    def recount_sizes(self) -> None:
+        """ Recalculate 'segment_sizes' and 'segment_max_durations' from segment hashes (once on start) """
+        filenames = self.client.zrange(SEGMENTS, 0, -1)
+        pipe = self.client.pipeline(transaction=False)
+        for filename in filenames:
+            pipe.hmget(self.segment_key(filename), 'size', 'start', 'finish')
+
+        sizes = {}
+        durations = {}
+        for filename, (size, start, finish) in zip(filenames, pipe.execute()):
+            camera_name = extract_name(filename)
+            sizes[camera_name] = sizes.get(camera_name, 0) + int(size or 0)
+            if start and finish:
+                durations[camera_name] = max(durations.get(camera_name, 0), float(finish) - float(start))
+
+        pipe = self.client.pipeline()
+        pipe.delete(SEGMENT_SIZES, SEGMENT_MAX_DURATIONS)
+        if sizes:
+            pipe.hset(SEGMENT_SIZES, mapping=sizes)
+        if durations:
+            pipe.hset(SEGMENT_MAX_DURATIONS, mapping=durations)
+        pipe.execute()
+
+    def filenames(self, camera_name: str) -> List[str]:
+        return self.client.zrange(self.camera_key(camera_name), 0, -1)
+
+    def lookback(self, camera_names: Optional[Iterable[str]] = None) -> float:
+        """
+        Longest segment duration in seconds for given cameras (all cameras by default).
+        """
+        durations = self.client.hgetall(SEGMENT_MAX_DURATIONS)
+        if camera_names is not None:
+            durations = {name: durations[name] for name in camera_names if name in durations}
+        return max([self.max_duration, *(float(value) for value in durations.values())])
+
+    def find(self, start_time: datetime, finish_time: datetime,
+             camera_names: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Find segments which overlap [start_time, finish_time].
+        Only segments started in [start_time - lookback, finish_time] are checked,
+        lookback is the longest recorded segment (at least max_duration).
+        """
+        lookback = self.lookback(camera_names)
+        min_score = start_time.timestamp() - lookback
+        max_score = finish_time.timestamp()
+        keys = [self.camera_key(name) for name in camera_names] if camera_names is not None else [SEGMENTS]
+
+        candidates = []
+        for key in keys:
+            candidates.extend(self.client.zrange_by_score(key, min_score, max_score))
+
+        pipe = self.client.pipeline(transaction=False)
+        for filename in candidates:
+            pipe.hgetall(self.segment_key(filename))
+
+        result = []
+        for filename, raw_segment in zip(candidates, pipe.execute()):
+            segment = self._parse(raw_segment)
+            if segment is None:
+                continue
+            file_start = segment['start_time']
+            file_finish = segment['finish_time'] or file_start + timedelta(seconds=lookback)
+            # сегменты без длительности считаются поврежденными
+            if file_finish - file_start < timedelta(seconds=1):
+                continue
+            if file_start <= finish_time and start_time <= file_finish:
+                result.append(filename)
+
+        result.sort()
+        return result
+
+    def rebuild(self, media_path: str) -> None:
+        """ Fill index with already recorded files (full directory scan, used once on empty index) """
+        for filename in os.listdir(media_path):
+            if filename.endswith(PARTIAL_SUFFIX):
+                continue
+            try:
+                start_time = datetime.strptime(extract_datetime(filename), Config.DATETIME_FORMAT)
+            except ValueError:
+                continue
+            duration = get_duration(filename, media_path)
+            self.add(filename,
+                     start_time=start_time,
+                     finish_time=start_time + timedelta(seconds=duration),
+                     frames=duration * Config.FPS,
+                     size=os.path.getsize(os.path.join(media_path, filename)))
+
+    @staticmethod
+    def _parse(raw_segment: Dict) -> Optional[Dict]:
+        if not raw_segment:
+            return None
+        finish = raw_segment.get('finish')
+        return {
+            'start_time': datetime.fromtimestamp(float(raw_segment['start'])),
+            'finish_time': datetime.fromtimestamp(float(finish)) if finish else None,
+            'frames': int(raw_segment.get('frames') or 0),
+            'size': int(raw_segment.get('size') or 0),
+        }
+
+
+segment_index = SegmentIndex(redis_client, max_duration=Config.VIDEO_DURATION)
+
+
+def check_unfinished_records(camera_name: Optional[str] = None):
+    """
+    Replay journal of segments, which were recorded when recorders stopped (crash, power off).
+    Only these files are checked (no directory scan): recorded part is renamed from '.partial'
+    and finalized, empty files are discarded. Segments of aruco cameras are queued for upload.
+    Should be called before recorders are started (with camera_name - by recorder of this camera
+    on every start, also after restart of its process).
+    """
+    aruco_cameras = {cam[1] for cam in Config.ARUCO_CAMERAS}
+    queued = None
+    for filename in segment_index.recording():
+        if camera_name is not None and extract_name(filename) != camera_name:
+            continue
+        filepath = os.path.join(Config.MEDIA_PATH, filename)
+        partial_path = filepath + PARTIAL_SUFFIX
+        if os.path.exists(partial_path):
+            if get_duration(filename + PARTIAL_SUFFIX) >= 1:
+                os.replace(partial_path, filepath)
+            else:
+                os.remove(partial_path)
+
+        if not os.path.exists(filepath):
+            segment_index.remove(filename)
+            segment_index.finish(filename)
+            continue
+
+        segment = segment_index.get(filename)
+        if segment is None or segment['finish_time'] is None:
+            start_time = segment['start_time'] if segment else clip_start_time(filename)
+            duration = get_duration(filename)
+            segment_index.add(filename,
+                              start_time=start_time,
+                              finish_time=start_time + timedelta(seconds=duration),
+                              frames=duration * Config.FPS,
+                              size=os.path.getsize(filepath))
+
+        if extract_name(filename) in aruco_cameras:
+            if queued is None:
+                queued = set(upload_queue.items())
+            if filename not in queued:
+                upload_queue.put(filename)
+
+        segment_index.finish(filename)
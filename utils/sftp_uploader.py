@@ -0,0 +1,137 @@
+import hashlib
+import os
+import threading
+
+import paramiko
+from paramiko.sftp_client import SFTPClient
+
+from config import Config
+
+
+class SFTPUploader:
+    """
+    Keeps one SSH transport between upload cycles.
+    Every upload worker opens its own SFTP channel over this transport.
+    """
+    def __init__(self, url: str, username: str, password: str, port: int = 22):
+        self.url = url
+        self.port = port
+        self.username = username
+        self.password = password
+        self.client = None
+        self.lock = threading.Lock()
+
+    def is_connected(self) -> bool:
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+
+        return transport is not None and transport.is_active()
+
+    def connect(self) -> None:
+        """ Create SSH connection, if there is no active one """
+        with self.lock:
+            if self.is_connected():
+                return
+            self.close()
+
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(hostname=self.url,
+                           port=self.port,
+                           username=self.username,
+                           password=self.password,
+                           auth_timeout=30,
+                           timeout=30,
+                           banner_timeout=30)
+            client.get_transport().set_keepalive(30)
+            self.client = client
+
+    def close(self) -> None:
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def open_sftp(self) -> SFTPClient:
+        """ New SFTP channel over existing transport """
+        sftp = SFTPClient.from_transport(self.client.get_transport(),
+                                         window_size=Config.SFTP_WINDOW_SIZE,
+                                         max_packet_size=Config.SFTP_MAX_PACKET_SIZE)
+        sftp.get_channel().settimeout(30)
+        sftp.chdir(Config.DESTINATION_DISK)
+
+        return sftp
+
+    @staticmethod
+    def put(sftp: SFTPClient, local_path: str, remote_path: str) -> int:
+        """
+        Resumable upload.
+        Data is written to '<remote_path>.part' with pipelined writes (no waiting for server
+        reply after every request). If '.part' exists after previous attempt, upload continues
+        from its size. After size (and checksum, if server supports it) verification
+        '.part' is renamed to remote_path.
+        :return: bytes sent in this call
+        """
+        file_size = os.path.getsize(local_path)
+        part_path = f'{remote_path}.part'
+        try:
+            offset = sftp.stat(part_path).st_size
+        except FileNotFoundError:
+            offset = 0
+        if offset > file_size:
+            offset = 0
+
+        with open(local_path, 'rb') as local_file:
+            local_file.seek(offset)
+            # 'r+' - запись без обрезки уже выгруженной части
+            with sftp.open(part_path, 'r+b' if offset else 'wb') as remote_file:
+                remote_file.seek(offset)
+                remote_file.set_pipelined(True)
+                while True:
+                    data = local_file.read(Config.SFTP_CHUNK_SIZE)
+                    if not data:
+                        break
+                    remote_file.write(data)
+
+        remote_size = sftp.stat(part_path).st_size
+        if remote_size != file_size:
+            # недописанная часть удаляется, чтобы не продолжать с неверного смещения
+            sftp.remove(part_path)
+            raise IOError(f'size mismatch in put! {remote_size} != {file_size}')
+
+        if Config.SFTP_VERIFY_CHECKSUM:
+            SFTPUploader.verify_checksum(sftp, local_path, part_path)
+
+        SFTPUploader.rename(sftp, part_path, remote_path)
+
+        return file_size - offset
+
+    @staticmethod
+    def verify_checksum(sftp: SFTPClient, local_path: str, remote_path: str) -> None:
+        """ Compare sha1 of local and remote file (only if server supports 'check-file' extension) """
+        try:
+            with sftp.open(remote_path, 'rb') as remote_file:
+                remote_hash = remote_file.check('sha1')
+        except IOError:
+            return
+
+        local_hash = hashlib.sha1()
+        with open(local_path, 'rb') as local_file:
+            for data in iter(lambda: local_file.read(Config.SFTP_CHUNK_SIZE), b''):
+                local_hash.update(data)
+
+        if remote_hash != local_hash.digest():
+            sftp.remove(remote_path)
+            raise IOError(f'checksum mismatch in put! {remote_path}')
+
+    @staticmethod
+    def rename(sftp: SFTPClient, source_path: str, destination_path: str) -> None:
+        """ Atomic rename with overwrite (posix-rename extension), or remove + rename """
+        try:
+            sftp.posix_rename(source_path, destination_path)
+        except IOError:
+            try:
+                sftp.remove(destination_path)
+            except FileNotFoundError:
+                pass
+            sftp.rename(source_path, destination_path)
@@ -0,0 +1,77 @@
+import os
+import threading
+from time import time, sleep
+from typing import Dict, Iterable, Union
+
+from utils.redis_client import redis_client, RedisClient
+from utils.variables import NETWORK_CONNECTION, LOADING_STATUS, STATE_CHANGES
+from config import Config
+
+
+class StateCache:
+    """
+    In-process copy of state flags stored in redis (network connection, loading status).
+    Background thread receives changes from 'state_changes' channel and re-reads all keys
+    every ttl seconds (in case a message was lost), so get() never touches redis.
+    Thread is started lazily on the first get() in every process.
+    """
+    def __init__(self, client: RedisClient, keys: Iterable[str], ttl: float = 30):
+        self.client = client
+        self.keys = list(keys)
+        self.ttl = ttl
+        self.values: Dict[str, Union[float, str, None]] = {}
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def set(self, key: str, value: Union[int, str, bool]) -> None:
+        """ Write value to redis and notify caches in other threads and processes """
+        if isinstance(value, bool):
+            value = float(value)
+        pipe = self.client.pipeline()
+        pipe.set(key, value)
+        pipe.publish(STATE_CHANGES, key)
+        pipe.execute()
+        self.values[key] = self.client.parse(value)
+
+    def get(self, key: str) -> Union[float, str, None]:
+        """ :return: last known value (None if unknown) """
+        if self.pid != os.getpid():
+            self.start()
+
+        return self.values.get(key)
+
+    def start(self) -> None:
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            threading.Thread(target=self.listen, name='StateCache', daemon=True).start()
+
+    def refresh(self) -> None:
+        for key, value in zip(self.keys, self.client.mget(self.keys)):
+            self.values[key] = value
+
+    def listen(self) -> None:
+        """ Update values on notifications, full refresh every ttl seconds; reconnect on errors """
+        while True:
+            try:
+                events = self.client.pubsub(STATE_CHANGES)
+                self.refresh()
+                refreshed = time()
+                while True:
+                    message = events.get_message(ignore_subscribe_messages=True, timeout=self.ttl)
+                    if message and message['data'] in self.keys:
+                        self.values[message['data']] = self.client.get(message['data'])
+                    if time() - refreshed >= self.ttl:
+                        self.refresh()
+                        refreshed = time()
+            except Exception:
+                # redis недоступен - остаются последние известные значения
+                sleep(self.ttl)
+
+
+state_cache = StateCache(redis_client, keys=(NETWORK_CONNECTION, LOADING_STATUS), ttl=Config.STATE_CACHE_TTL)
@@ -2,14 +2,18 @@ import os
 import shutil
 import subprocess
 import socket
-from typing import List
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Iterator, BinaryIO, Callable
 from functools import wraps
 
-import cv2
-
-from utils.redis_client import redis_client
+from utils.probe import probe_duration, keyframe_times, video_codec
+from utils.encoder import get_encoder_profile, encoder_args, CODEC_SAMPLE_ENTRIES
 from config import Config
-from utils.variables import READY_TO_UPLOAD
+
+
+PARTIAL_SUFFIX = '.partial'  # сегмент, который еще записывается
 
 
 def extract_datetime(filename):
@@ -30,28 +34,22 @@ def ping_server(host):
     return False
 
 
-def check_unfinished_records():
-    files = os.listdir(Config.MEDIA_PATH)
-    finished_records = redis_client.get_full_list(READY_TO_UPLOAD)
-    camera_name = [cam[1] for cam in Config.ARUCO_CAMERAS]
-    for file in files:
-        if extract_name(file) in camera_name and file not in finished_records:
-            redis_client.rpush(READY_TO_UPLOAD, file)
-
-
 def get_duration(filename, folder=None):
     if folder is None:
         folder = Config.MEDIA_PATH
 
-    video = cv2.VideoCapture(os.path.join(folder, filename))
-    frame_count = video.get(cv2.CAP_PROP_FRAME_COUNT)
-    duration = int(frame_count / Config.FPS)
+    # длительность читается из контейнера (mvhd / tfdt+trun фрагментов) и кэшируется
+    duration = int(probe_duration(os.path.join(folder, filename)))
 
     return duration
 
 
-def get_free_space() -> float:
-    total, used, free = shutil.disk_usage("/")
+def get_free_space(path: Optional[str] = None) -> float:
+    """
+    Free space on filesystem of path (Config.MEDIA_PATH by default)
+    :return: Gb
+    """
+    total, used, free = shutil.disk_usage(path or Config.MEDIA_PATH)
 
     return free / 2 ** 30
 
@@ -64,32 +62,265 @@ def get_clips_by_name(clips: List[str], name: str):
     return None
 
 
-def merge_clips(clips: List[str]) -> str:
+def media_file_path(filename: str) -> str:
     """
-    Merge clips
-    :param clips: list
-    :return output merged clip: str
+    Path of segment in Config.MEDIA_PATH, '.partial' file if segment is still recorded
+    :return: str
     """
+    path = os.path.join(Config.MEDIA_PATH, filename)
+    if not os.path.exists(path) and os.path.exists(path + PARTIAL_SUFFIX):
+        return path + PARTIAL_SUFFIX
+
+    return path
+
 
-    output_name = f'{clips[0].split(".")[0]}_all.mp4'
-    output_path = os.path.join(Config.TEMP_PATH, output_name)
+def clip_start_time(filename: str) -> datetime:
+    return datetime.strptime(extract_datetime(filename), Config.DATETIME_FORMAT)
 
-    with open('input.txt', 'w') as f:
-        for filename in clips:
-            f.write(f"file '{os.path.join(Config.MEDIA_PATH, filename)}'\n")
+
+def precise_start_supported(filename: str) -> bool:
+    """
+    Head of clip is re-encoded with encoder profile of camera and joined with the rest by stream copy,
+    so segment should be encoded by recorder with the same codec (not a stream copy camera,
+    profile of camera is not changed since recording)
+    :return: bool
+    """
+    camera_name = extract_name(filename)
+    if camera_name in Config.STREAM_COPY_CAMERAS:
+        return False
+
+    codec = get_encoder_profile(camera_name)['codec']
+    return video_codec(media_file_path(filename)) in CODEC_SAMPLE_ENTRIES.get(codec, ())
+
+
+def encode_clip_head(entry: Dict, camera_name: str, head_path: str) -> Optional[Dict]:
+    """
+    Re-encode first clip from inpoint to the next keyframe (frame accurate start),
+    entry is moved to this keyframe (or dropped, if the whole window is re-encoded)
+    :return: concat entry of head file or None, if inpoint is already a keyframe
+    """
+    inpoint = entry['inpoint']
+    outpoint = entry.get('outpoint')
+    keyframe = next((time for time in keyframe_times(entry['file']) if time >= inpoint), None)
+    if keyframe is not None and keyframe - inpoint < 0.001:
+        return None
+
+    end = keyframe
+    if outpoint is not None and (end is None or outpoint < end):
+        end = outpoint
 
     subprocess.call(['ffmpeg',
-                     '-f', 'concat',
-                     '-safe', '0',
-                     '-i', 'input.txt',
-                     '-c', 'copy',
-                     '-y', output_path])
+                     '-y',
+                     '-ss', str(inpoint),
+                     '-i', entry['file'],
+                     *(['-t', str(end - inpoint)] if end is not None else []),
+                     '-an',
+                     *encoder_args(get_encoder_profile(camera_name), Config.FPS),
+                     head_path])
+
+    if end == keyframe:
+        entry['inpoint'] = keyframe
+    else:
+        entry.clear()
+
+    return {'file': head_path}
+
+
+def temp_file(suffix: str) -> str:
+    """ Unique file in Config.TEMP_PATH (every merge job has its own manifest and head file) """
+    descriptor, path = tempfile.mkstemp(suffix=suffix, dir=Config.TEMP_PATH)
+    os.close(descriptor)
+
+    return path
+
+
+def merged_clip_name(clips: List[str], start_time: Optional[datetime] = None,
+                     finish_time: Optional[datetime] = None, suffix: str = 'all') -> str:
+    """
+    Name of merged clip: first clip, requested window (requests with the same first clip
+    don't overwrite each other's output) and suffix
+    :return: str
+    """
+    window = '-'.join(time.strftime('%H-%M-%S') for time in (start_time, finish_time) if time is not None)
+
+    return f'{clips[0].split(".")[0]}_{window + "_" if window else ""}{suffix}.mp4'
+
+
+def merged_clip_start(clips: List[str], start_time: Optional[datetime] = None) -> datetime:
+    """
+    Real start of merged clip: start_time with Config.PRECISE_CLIP_START,
+    else keyframe at or before start_time in the first clip (stream copy starts from it)
+    :return: datetime
+    """
+    first_start = clip_start_time(clips[0])
+    if start_time is None or start_time <= first_start:
+        return first_start
+    if Config.PRECISE_CLIP_START and precise_start_supported(clips[0]):
+        return start_time
 
-    os.remove('input.txt')
+    inpoint = (start_time - first_start).total_seconds()
+    keyframe = max((time for time in keyframe_times(media_file_path(clips[0])) if time <= inpoint), default=0.0)
+
+    return first_start + timedelta(seconds=keyframe)
+
+
+def merge_clips(clips: List[str], start_time: Optional[datetime] = None,
+                finish_time: Optional[datetime] = None, suffix: str = 'all', output_dir: Optional[str] = None) -> str:
+    """
+    Merge clips without re-encoding.
+    With start_time/finish_time output is cut to this window: first clip starts from keyframe
+    before start_time (exactly from start_time, if Config.PRECISE_CLIP_START and codec
+    of segment allows it), last clip ends at finish_time.
+    :param clips: list
+    :param start_time: datetime
+    :param finish_time: datetime
+    :param suffix: output name suffix (different for every consumer of TEMP_PATH and every request)
+    :param output_dir: directory of output clip (Config.TEMP_PATH by default)
+    :return output merged clip: str
+    """
+
+    output_name = merged_clip_name(clips, start_time, finish_time, suffix)
+    output_path = os.path.join(output_dir or Config.TEMP_PATH, output_name)
+
+    entries = [{'file': media_file_path(filename)} for filename in clips]
+    if start_time is not None:
+        inpoint = (start_time - clip_start_time(clips[0])).total_seconds()
+        if inpoint > 0:
+            entries[0]['inpoint'] = inpoint
+    if finish_time is not None:
+        outpoint = (finish_time - clip_start_time(clips[-1])).total_seconds()
+        if outpoint > 0:
+            entries[-1]['outpoint'] = outpoint
+
+    head_path = None
+    if Config.PRECISE_CLIP_START and 'inpoint' in entries[0] and precise_start_supported(clips[0]):
+        head_path = temp_file('.mp4')
+        head = encode_clip_head(entries[0], extract_name(clips[0]), head_path)
+        if head is not None:
+            entries.insert(0, head)
+
+    manifest_path = temp_file('.txt')
+    with open(manifest_path, 'w') as f:
+        for entry in entries:
+            if not entry:
+                continue
+            f.write(f"file '{entry['file']}'\n")
+            # inpoint - ближайший предшествующий ключевой кадр (stream copy), outpoint - точно
+            if 'inpoint' in entry:
+                f.write(f"inpoint {entry['inpoint']:.3f}\n")
+            if 'outpoint' in entry:
+                f.write(f"outpoint {entry['outpoint']:.3f}\n")
+
+    command = ['ffmpeg',
+               '-f', 'concat',
+               '-safe', '0',
+               '-i', manifest_path,
+               '-c', 'copy',
+               '-y', output_path]
+    returncode = subprocess.call(command)
+
+    os.remove(manifest_path)
+    if head_path is not None and os.path.exists(head_path):
+        os.remove(head_path)
+    if returncode != 0:
+        # недописанный клип не должен попасть в выгрузку
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise subprocess.CalledProcessError(returncode, command)
 
     return output_name
 
 
+# общий для всех потоков пул: число одновременных ffmpeg ограничено Config.MERGE_WORKERS
+merge_pool = ThreadPoolExecutor(max_workers=Config.MERGE_WORKERS, thread_name_prefix='merge')
+
+
+def merge_clips_concurrently(jobs: List[List[str]], start_time: Optional[datetime] = None,
+                             finish_time: Optional[datetime] = None, suffix: str = 'all',
+                             output_dir: Optional[str] = None) -> Iterator[str]:
+    """
+    Merge clips of every job (usually one job per camera) in merge_pool.
+    If one merge fails (or iteration is stopped), outputs of other merges, which are not
+    yielded yet, are removed and the error is re-raised.
+    :return: iterator over output clips in order of completion
+    """
+    futures = {merge_pool.submit(merge_clips, clips, start_time, finish_time, suffix, output_dir):
+               merged_clip_name(clips, start_time, finish_time, suffix)
+               for clips in jobs if clips}
+    yielded = set()
+    try:
+        for future in as_completed(futures):
+            output_name = future.result()
+            yielded.add(output_name)
+            yield output_name
+    except BaseException:
+        for future, output_name in futures.items():
+            if output_name in yielded or future.cancel() or future.exception() is not None:
+                continue
+            output_path = os.path.join(output_dir or Config.TEMP_PATH, output_name)
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        raise
+
+
+def copy_file(source: BinaryIO, destination: BinaryIO, callback: Optional[Callable[[int], None]] = None,
+              size: Optional[int] = None) -> int:
+    """
+    Copy file in kernel (copy_file_range on one filesystem, else sendfile),
+    with fallback to reading by Config.EXPORT_BUFFER_SIZE blocks
+    :param callback: called with number of bytes copied by every step (progress)
+    :param size: copy not more than size bytes (file may still be recorded)
+    :return: bytes copied
+    """
+    source_fd, destination_fd = source.fileno(), destination.fileno()
+    same_device = os.fstat(source_fd).st_dev == os.fstat(destination_fd).st_dev
+    copied = 0
+
+    def sendfile(src: int, dst: int, count: int) -> int:
+        return os.sendfile(dst, src, None, count)
+
+    kernel_copy = os.copy_file_range if same_device and hasattr(os, 'copy_file_range') else None
+    if kernel_copy is None and hasattr(os, 'sendfile'):
+        kernel_copy = sendfile
+
+    while True:
+        count = Config.EXPORT_BUFFER_SIZE if size is None else min(Config.EXPORT_BUFFER_SIZE, size - copied)
+        if count <= 0:
+            break
+        try:
+            if kernel_copy is not None:
+                sent = kernel_copy(source_fd, destination_fd, count)
+            else:
+                data = source.read(count)
+                destination.write(data)
+                sent = len(data)
+        except OSError:
+            if kernel_copy is None or copied:
+                raise
+            # файловая система не поддерживает копирование в ядре
+            kernel_copy = None
+            continue
+        if not sent:
+            break
+        copied += sent
+        if callback is not None:
+            callback(sent)
+
+    return copied
+
+
+def frame_to_buffer(frame) -> memoryview:
+    """
+    Byte view of frame without copying (for writing to encoder pipe)
+    :param frame: numpy array
+    :return: memoryview
+    """
+    if not frame.flags.c_contiguous:
+        frame = frame.copy()
+
+    return memoryview(frame).cast('B')
+
+
 def get_self_ip():
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
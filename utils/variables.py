@@ -5,3 +5,11 @@ ERROR_MESSAGES = 'error_messages'
 COORDINATES = 'coordinates'
 LOADING_STATUS = 'loading_status'
 NETWORK_CONNECTION = 'network_connection'
+SEGMENTS = 'segments'
+SEGMENT = 'segment'
+SEGMENT_SIZES = 'segment_sizes'
+SEGMENT_MAX_DURATIONS = 'segment_max_durations'
+RECORDING = 'recording'
+METRICS = 'metrics'
+CONNECTOR_EVENTS = 'connector_events'
+STATE_CHANGES = 'state_changes'